@@ -0,0 +1,70 @@
+"""Micro-benchmark of the bb_util batch API against the per-box functions.
+
+Run from the repository root:
+    python -m benchmarks.bb_util_benchmark -boxes 16
+The batch functions are checked against the per-box ones by tests/test_bb_util.py.
+"""
+import argparse
+import timeit
+import numpy as np
+import utils.bb_util as bb_util
+
+
+def random_boxes(num_boxes, rng):
+    xy = rng.uniform(0, 500, size=(2, num_boxes))
+    wh = rng.uniform(5, 200, size=(2, num_boxes))
+    return np.ascontiguousarray(np.concatenate((xy, xy + wh)), dtype=np.float32)
+
+
+def run_benchmark(num_boxes, repeat, number):
+    rng = np.random.default_rng(1)
+    boxes = random_boxes(num_boxes, rng)
+    crops = random_boxes(num_boxes, rng)
+    out = np.empty_like(boxes)
+    work = np.empty_like(boxes)
+
+    def per_box_from_crop():
+        for i in range(num_boxes):
+            bb_util.from_crop_coordinate_system(boxes[:, i], crops[:, i], 2, 227)
+
+    def batch_from_crop():
+        bb_util.from_crop_coordinate_system_batch(boxes, crops, 2, 227, out=out, work=work)
+
+    def per_box_xywh():
+        for i in range(num_boxes):
+            bb_util.xyxy_to_xywh(boxes[:, i])
+
+    def batch_xywh():
+        bb_util.xyxy_to_xywh_batch(boxes, out=out)
+
+    def per_box_scale():
+        for i in range(num_boxes):
+            bb_util.scale_bbox(boxes[:, i], 1.5)
+
+    def batch_scale():
+        bb_util.scale_bbox_batch(boxes, 1.5, out=out)
+
+    results = {}
+    for name, func in (('from_crop_coordinate_system', per_box_from_crop),
+                       ('from_crop_coordinate_system_batch', batch_from_crop),
+                       ('xyxy_to_xywh', per_box_xywh),
+                       ('xyxy_to_xywh_batch', batch_xywh),
+                       ('scale_bbox', per_box_scale),
+                       ('scale_bbox_batch', batch_scale)):
+        best = min(timeit.repeat(func, repeat=repeat, number=number)) / number
+        results[name] = best
+    return results
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='bb_util batch API benchmark.')
+    parser.add_argument('-boxes', type=int, default=16, help='Boxes per frame')
+    parser.add_argument('-repeat', type=int, default=5, help='Timing repeats')
+    parser.add_argument('-number', type=int, default=1000, help='Calls per repeat')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    for name, seconds in run_benchmark(args.boxes, args.repeat, args.number).items():
+        print(f'{name:36s} {seconds * 1e6:10.2f} us/frame')
@@ -0,0 +1,230 @@
+"""
+Sweeps the CPU resource settings of resources.py on this host and reports the best split of its cores between
+the detector, the tracker and the frame codec, without the Re3 checkpoint or the Faster R-CNN weights.
+
+For every candidate split a server process runs a randomly initialized Faster R-CNN back to back on the
+detector stage while decoding key frames on the codec stage, and a client process decodes and tracks frames
+at the video frame rate on the tracker stage while the video reader decodes thumbnails on the codec stage,
+both for the same seconds. Splits keeping at least -min_detector_share of the best detector throughput are
+ranked by the 99th percentile of the tracker time per frame, e.g.
+    python -m benchmarks.cpu_benchmark -seconds 20 -save_config cpu.json
+    python server.py ... -cpu_config cpu.json
+    python client.py ... -cpu_config cpu.json
+"""
+import argparse
+import json
+import multiprocessing
+import statistics
+import threading
+import time
+import cv2
+import numpy as np
+
+import frame_utils
+from resources import ResourceConfig, available_cores, format_cores
+from benchmarks.micro_benchmark import synthetic_frames, random_detector
+
+
+KEY_FRAME_RATE = 5      # key frames decoded by the server per second
+TIMEOUT = 600           # seconds before a split is abandoned
+
+
+# Candidate splits of the cores, the library defaults first.
+# @return{list} (name, ResourceConfig) pairs.
+def candidate_splits(cores):
+    splits = [('defaults', ResourceConfig())]
+    core_num = len(cores)
+    codec_num = max(1, core_num // 8)
+    for tracker_num in sorted({1, 2, core_num // 4}):
+        detector_num = core_num - tracker_num - codec_num
+        if tracker_num < 1 or detector_num < 1:
+            continue
+        threads = {'detector': detector_num, 'tracker': tracker_num}
+        name = f'd{detector_num}/t{tracker_num}/c{codec_num}'
+        splits.append((f'threads {name}', ResourceConfig(dict(threads), cv2_threads=codec_num)))
+        splits.append((f'pinned {name}', ResourceConfig(dict(threads), cv2_threads=codec_num, cores={
+            'tracker': cores[:tracker_num],
+            'codec': cores[tracker_num:tracker_num + codec_num],
+            'detector': cores[tracker_num + codec_num:],
+        })))
+    if len(splits) == 1:
+        # too few cores to give each stage its own, only the thread pools are capped
+        splits.append(('threads d1/t1/c1', ResourceConfig({'detector': 1, 'tracker': 1}, cv2_threads=1)))
+    return splits
+
+
+# Runs each worker in its own thread on its stage, started together with the other process through barrier.
+# @workers{dict} name -> (stage, factory, interval), factory() runs on the stage thread and returns the step
+#                function timed per call, calls start at most every interval seconds.
+# @return{dict} name -> step times in seconds.
+def run_workers(config, workers, seconds, barrier):
+    ready = threading.Barrier(len(workers) + 1)
+    go = threading.Event()
+    stop = threading.Event()
+    samples = {name: [] for name in workers}
+
+    def work(name, stage, factory, interval):
+        config.enter(stage)
+        step = factory()
+        ready.wait()
+        go.wait()
+        next_start = time.perf_counter()
+        while not stop.is_set():
+            start = time.perf_counter()
+            step()
+            samples[name].append(time.perf_counter() - start)
+            next_start += interval
+            time.sleep(max(0.0, next_start - time.perf_counter()))
+
+    threads = [threading.Thread(target=work, args=(name,) + worker, daemon=True) for name, worker in workers.items()]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    barrier.wait()
+    go.set()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def detector_factory(size):
+    def factory():
+        import torch
+        frame0, _, _ = synthetic_frames(size)
+        model = random_detector()
+        image = torch.from_numpy(frame0.image).permute(2, 0, 1).float() / 255
+
+        def step():
+            with torch.no_grad():
+                model([image])
+        step()
+        return step
+    return factory
+
+
+def decode_factory(size, mode=cv2.IMREAD_COLOR):
+    frame0, _, _ = synthetic_frames(size)
+    buffer = np.frombuffer(frame_utils.image_to_bytes(frame0.image), dtype='uint8')
+    return lambda: lambda: cv2.imdecode(buffer, mode)
+
+
+def tracker_factory(size, objects):
+    def factory():
+        from tracker.re3_tracker import Re3Tracker
+        _, frame1, boxes = synthetic_frames(size, objects)
+        buffer = np.frombuffer(frame_utils.image_to_bytes(frame1.image), dtype='uint8')
+        tracker = Re3Tracker(model_path=None)
+
+        def step():
+            # the client loop decodes the full frame of the tracked streams, then tracks every object
+            image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            # the random network drifts off target, seeding every call does the same crops and forward pass
+            for i, bbox in enumerate(boxes):
+                tracker.track(i, image, bbox=bbox)
+        step()
+        return step
+    return factory
+
+
+def run_server(config_dict, options, barrier, results):
+    config = ResourceConfig.from_dict(config_dict)
+    config.apply()
+    samples = run_workers(config, {
+        'detector': ('detector', detector_factory(options['detector_size']), 0.0),
+        'key_frame_decode': ('codec', decode_factory(options['size']), 1 / KEY_FRAME_RATE),
+    }, options['seconds'], barrier)
+    results.put(('server', samples))
+
+
+def run_client(config_dict, options, barrier, results):
+    config = ResourceConfig.from_dict(config_dict)
+    config.apply()
+    samples = run_workers(config, {
+        'tracker': ('tracker', tracker_factory(options['size'], options['objects']), 1 / options['frame_rate']),
+        'thumbnail_decode': ('codec', decode_factory(options['size'], frame_utils.THUMBNAIL_MODE),
+                             1 / options['frame_rate']),
+    }, options['seconds'], barrier)
+    results.put(('client', samples))
+
+
+def summarize(samples, seconds):
+    tracker_ms = np.array(samples['tracker']) * 1000
+    return {
+        'tracker_p50_ms': float(np.percentile(tracker_ms, 50)),
+        'tracker_p99_ms': float(np.percentile(tracker_ms, 99)),
+        'tracker_stdev_ms': float(statistics.stdev(tracker_ms)) if len(tracker_ms) > 1 else 0.0,
+        'tracker_fps': len(tracker_ms) / seconds,
+        'detector_fps': len(samples['detector']) / seconds,
+        'detector_mean_ms': float(np.mean(samples['detector']) * 1000) if samples['detector'] else None,
+    }
+
+
+def run_split(config, options):
+    results = multiprocessing.Queue()
+    barrier = multiprocessing.Barrier(2)
+    processes = [multiprocessing.Process(target=target, args=(config.to_dict(), options, barrier, results))
+                 for target in (run_server, run_client)]
+    for process in processes:
+        process.start()
+    samples = {}
+    try:
+        for _ in processes:
+            _, process_samples = results.get(timeout=TIMEOUT)
+            samples.update(process_samples)
+    finally:
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+    return summarize(samples, options['seconds'])
+
+
+# The split with the lowest tracker p99 among those within min_detector_share of the best detector throughput.
+def best_split(runs, min_detector_share):
+    best_detector_fps = max(run['result']['detector_fps'] for run in runs)
+    eligible = [run for run in runs if run['result']['detector_fps'] >= min_detector_share * best_detector_fps]
+    return min(eligible, key=lambda run: run['result']['tracker_p99_ms'])
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='CPU resource split sweep.')
+    parser.add_argument('-seconds', type=float, default=10.0, help='Seconds each split runs')
+    parser.add_argument('-objects', type=int, default=4, help='Tracked objects')
+    parser.add_argument('-size', type=str, default='1280x720', help='WxH of the video frames')
+    parser.add_argument('-detector_size', type=str, default='640x360', help='WxH of the detector input')
+    parser.add_argument('-frame_rate', type=int, default=30, help='Video FPS the tracker is paced to')
+    parser.add_argument('-min_detector_share', type=float, default=0.8,
+                        help='Fraction of the best detector throughput a split must keep to be ranked')
+    parser.add_argument('-out', type=str, default=None, help='JSON output path of all splits')
+    parser.add_argument('-save_config', type=str, default=None, help='Write the best split as a -cpu_config file')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    options = {
+        'seconds': args.seconds,
+        'objects': args.objects,
+        'size': args.size,
+        'detector_size': args.detector_size,
+        'frame_rate': args.frame_rate,
+    }
+    cores = available_cores()
+    print(f'{len(cores)} cores: {format_cores(cores)}')
+    runs = []
+    for name, config in candidate_splits(cores):
+        result = run_split(config, options)
+        runs.append({'name': name, 'config': config.to_dict(), 'result': result})
+        print(f'{name:28s} tracker p50 {result["tracker_p50_ms"]:8.2f} ms  p99 {result["tracker_p99_ms"]:8.2f} ms  '
+              f'({result["tracker_fps"]:.1f} FPS)  detector {result["detector_fps"]:.2f} FPS')
+    best = best_split(runs, args.min_detector_share)
+    print(f'best: {best["name"]} ({ResourceConfig.from_dict(best["config"]).describe()})')
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'cores': cores, 'options': options, 'runs': runs, 'best': best['name']}, f, indent=2)
+    if args.save_config is not None:
+        with open(args.save_config, 'w') as f:
+            json.dump(best['config'], f, indent=2)
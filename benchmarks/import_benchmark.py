@@ -0,0 +1,117 @@
+"""
+Import time of the entry point modules and start-up time of their command lines, to keep torch and the other
+heavy packages off the start-up path.
+
+    python -m benchmarks.import_benchmark -save import_baseline.json
+    python -m benchmarks.import_benchmark -baseline import_baseline.json
+
+Each module is imported in a fresh interpreter with -X importtime and each script is run with -h. The median
+of -repeat runs is compared against the baseline, cases slower by more than -threshold and modules that now
+pull in one of HEAVY_PACKAGES are reported as regressions (exit code 1).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['client', 'server', 'offline', 'frame_utils', 'frame_transmission', 'object_transmission',
+           'detection_cache', 'tracker.association']
+SCRIPTS = ['client.py', 'server.py', 'offline.py']
+HEAVY_PACKAGES = ['torch', 'torchvision', 'PIL', 'scipy']
+TOP_IMPORTS = 5
+
+
+# @return{list} (name, self us, cumulative us) of the -X importtime report, in import order.
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def time_import(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    imports = parse_importtime(result.stderr)
+    # the module is reported last, after everything it imported
+    return imports[-1][2] / 1000, imports
+
+
+def time_script(script):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, '-h'], cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def run(modules, scripts, repeat):
+    results = {}
+    for module in modules:
+        samples = []
+        for _ in range(repeat):
+            milliseconds, imports = time_import(module)
+            samples.append(milliseconds)
+        names = {name for name, _, _ in imports}
+        heaviest = sorted(imports, key=lambda item: item[2], reverse=True)[1:TOP_IMPORTS + 1]
+        key = f'import {module}'
+        results[key] = {
+            'median_ms': statistics.median(samples),
+            'min_ms': min(samples),
+            'heavy': [package for package in HEAVY_PACKAGES if package in names],
+            'top': [[name, cumulative_us / 1000] for name, _, cumulative_us in heaviest],
+        }
+        print(f'{key:40s} {results[key]["median_ms"]:10.1f} ms  heavy: {results[key]["heavy"]}')
+    for script in scripts:
+        samples = [time_script(script) for _ in range(repeat)]
+        key = f'{script} -h'
+        results[key] = {'median_ms': statistics.median(samples), 'min_ms': min(samples)}
+        print(f'{key:40s} {results[key]["median_ms"]:10.1f} ms')
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result['median_ms'] / baseline[key]['median_ms']
+        if ratio > 1 + threshold:
+            regressions.append(f'{key}: {baseline[key]["median_ms"]:.1f} ms -> {result["median_ms"]:.1f} ms '
+                               f'({(ratio - 1) * 100:+.1f}%)')
+        added = set(result.get('heavy', [])) - set(baseline[key].get('heavy', []))
+        if added:
+            regressions.append(f'{key}: now imports {", ".join(sorted(added))}')
+    return regressions
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Import and start-up time of the entry points.')
+    parser.add_argument('-modules', type=str, nargs='+', default=MODULES, help='Modules to import')
+    parser.add_argument('-scripts', type=str, nargs='+', default=SCRIPTS, help='Scripts to run with -h')
+    parser.add_argument('-repeat', type=int, default=5, help='Runs per case')
+    parser.add_argument('-save', type=str, default=None, help='Write the results as a new baseline')
+    parser.add_argument('-baseline', type=str, default=None, help='Baseline to compare against')
+    parser.add_argument('-threshold', type=float, default=0.25, help='Relative slowdown reported as regression')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    results = run(args.modules, args.scripts, args.repeat)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,222 @@
+"""
+Micro-benchmarks of the per-frame hot functions across image sizes and object counts.
+
+    python -m benchmarks.micro_benchmark -save baseline.json
+    python -m benchmarks.micro_benchmark -baseline baseline.json
+
+Each case is warmed up and then timed in several repeats, the median of the repeats is compared against the
+baseline and cases slower by more than -threshold are reported as regressions (exit code 1).
+"""
+import argparse
+import json
+import socket
+import statistics
+import sys
+import threading
+import time
+import numpy as np
+
+import frame_utils
+import utils.bb_util as bb_util
+import utils.im_util as im_util
+from benchmarks.synthetic import SyntheticVideoReader
+
+
+SIZES = ['320x240', '640x360', '1280x720', '1920x1080']
+OBJECTS = [1, 4, 16]
+
+
+def synthetic_frames(size, objects=4):
+    width, height = (int(item) for item in size.split('x'))
+    reader = SyntheticVideoReader(2, width, height, objects)
+    return reader.get_frame(0), reader.get_frame(1), reader.boxes(0)
+
+
+def bench_diff_img(size):
+    frame0, frame1, _ = synthetic_frames(size)
+    return lambda: frame_utils.diff_img(frame0.image, frame1.image)
+
+
+def bench_image_to_bytes(size):
+    frame0, _, _ = synthetic_frames(size)
+    return lambda: frame_utils.image_to_bytes(frame0.image)
+
+
+def bench_bytes_to_image(size):
+    frame0, _, _ = synthetic_frames(size)
+    image_bytes = frame_utils.image_to_bytes(frame0.image)
+    return lambda: frame_utils.bytes_to_image(image_bytes)
+
+
+def bench_socket_recv_all(size):
+    # a JPEG key frame of this size, streamed by a thread on the other end of a socket pair
+    frame0, _, _ = synthetic_frames(size)
+    payload = frame_utils.image_to_bytes(frame0.image)
+    sender, receiver = socket.socketpair()
+    requests = threading.Semaphore(0)
+
+    def send_loop():
+        while True:
+            requests.acquire()
+            sender.sendall(payload)
+
+    threading.Thread(target=send_loop, daemon=True).start()
+
+    def run():
+        requests.release()
+        frame_utils.socket_recv_all(receiver, len(payload))
+    return run
+
+
+def bench_draw_bbox(objects):
+    frame0, _, boxes = synthetic_frames('1280x720', objects)
+    image = frame0.image.copy()
+
+    def run():
+        for i, bbox in enumerate(boxes):
+            frame_utils.draw_bbox(image, bbox, i)
+    return run
+
+
+def bench_get_cropped_input(objects):
+    frame0, _, boxes = synthetic_frames('1280x720', objects)
+
+    def run():
+        for bbox in boxes:
+            im_util.get_cropped_input(frame0.image, bbox, 2, 227)
+    return run
+
+
+def bench_bb_util(objects, batch):
+    _, _, boxes = synthetic_frames('1280x720', objects)
+    boxes = np.ascontiguousarray(boxes.T, dtype=np.float32)
+    crops = bb_util.scale_bbox_batch(boxes, 1.2)
+    out = np.empty_like(boxes)
+    work = np.empty_like(boxes)
+    if batch:
+        def run():
+            bb_util.xyxy_to_xywh_batch(boxes, out=out)
+            bb_util.scale_bbox_batch(boxes, 2, out=out)
+            bb_util.to_crop_coordinate_system_batch(boxes, crops, 2, 227, out=out, work=work)
+            bb_util.from_crop_coordinate_system_batch(out, crops, 2, 227, out=out, work=work)
+    else:
+        def run():
+            for i in range(boxes.shape[1]):
+                bb_util.xyxy_to_xywh(boxes[:, i])
+                bb_util.scale_bbox(boxes[:, i], 2)
+                in_crop = bb_util.to_crop_coordinate_system(boxes[:, i], crops[:, i], 2, 227)
+                bb_util.from_crop_coordinate_system(in_crop, crops[:, i], 2, 227)
+    return run
+
+
+def bench_track(objects):
+    from tracker.re3_tracker import Re3Tracker
+    _, frame1, boxes = synthetic_frames('1280x720', objects)
+    tracker = Re3Tracker(model_path=None)
+
+    def run():
+        # the random network drifts off target, seeding every call does the same crops and forward pass
+        for i, bbox in enumerate(boxes):
+            tracker.track(i, frame1.image, bbox=bbox)
+    return run
+
+
+def random_detector():
+    import torchvision
+    try:
+        model = torchvision.models.detection.fasterrcnn_resnet50_fpn(weights=None, weights_backbone=None)
+    except TypeError:
+        model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained=False, pretrained_backbone=False)
+    model.eval()
+    return model
+
+
+def bench_detect_object(size):
+    from server import ObjectDetectionServer
+    frame0, _, _ = synthetic_frames(size)
+    server = ObjectDetectionServer('127.0.0.1', 0, '127.0.0.1', 0)
+    server.model = random_detector()
+    return lambda: server.detect_object(frame0)
+
+
+# name -> (factory, parameter values, calls per repeat)
+CASES = {
+    'diff_img': (bench_diff_img, SIZES, 20),
+    'image_to_bytes': (bench_image_to_bytes, SIZES, 10),
+    'bytes_to_image': (bench_bytes_to_image, SIZES, 10),
+    'socket_recv_all': (bench_socket_recv_all, SIZES, 10),
+    'draw_bbox': (bench_draw_bbox, OBJECTS, 100),
+    'get_cropped_input': (bench_get_cropped_input, OBJECTS, 20),
+    'bb_util': (lambda objects: bench_bb_util(objects, False), OBJECTS, 100),
+    'bb_util_batch': (lambda objects: bench_bb_util(objects, True), OBJECTS, 100),
+    'Re3Tracker.track': (bench_track, OBJECTS, 1),
+    'detect_object': (bench_detect_object, SIZES, 1),
+}
+
+
+def time_case(func, number, warmup, repeat):
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number * 1000)
+    return {
+        'min_ms': min(samples),
+        'median_ms': statistics.median(samples),
+        'mean_ms': statistics.mean(samples),
+        'stdev_ms': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'repeat': repeat,
+        'number': number,
+    }
+
+
+def run(names, warmup, repeat):
+    results = {}
+    for name in names:
+        factory, params, number = CASES[name]
+        for param in params:
+            key = f'{name}[{param}]'
+            results[key] = time_case(factory(param), number, warmup, repeat)
+            print(f'{key:40s} {results[key]["median_ms"]:10.3f} ms  (+- {results[key]["stdev_ms"]:.3f})')
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result['median_ms'] / baseline[key]['median_ms']
+        if ratio > 1 + threshold:
+            regressions.append((key, baseline[key]['median_ms'], result['median_ms'], ratio))
+    return regressions
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the per-frame hot functions.')
+    parser.add_argument('-cases', type=str, nargs='+', default=list(CASES), choices=list(CASES),
+                        help='Cases to run')
+    parser.add_argument('-warmup', type=int, default=2, help='Untimed calls before timing')
+    parser.add_argument('-repeat', type=int, default=5, help='Timed repeats')
+    parser.add_argument('-save', type=str, default=None, help='Write the results as a new baseline')
+    parser.add_argument('-baseline', type=str, default=None, help='Baseline to compare against')
+    parser.add_argument('-threshold', type=float, default=0.1, help='Relative slowdown reported as regression')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    results = run(args.cases, args.warmup, args.repeat)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for key, before, after, ratio in regressions:
+            print(f'REGRESSION {key}: {before:.3f} ms -> {after:.3f} ms ({(ratio - 1) * 100:+.1f}%)')
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,158 @@
+"""
+End-to-end benchmark of the client and server over loopback, without a video directory, the Re3 checkpoint
+or the Faster R-CNN weights: frames come from a synthetic video, the server is a stub answering with the
+ground truth and the tracker runs a randomly initialized Re3Net. With a link latency the frames and the replies
+go through proxies delaying them by that much each way.
+
+Every combination of the scenario options is run in fresh client and server processes, e.g.
+    python -m benchmarks.pipeline_benchmark -objects 1 4 -resolutions 640x360 1280x720 -out bench.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import time
+
+from benchmarks.synthetic import SyntheticVideoReader, StubDetectionServer, DelayProxy
+
+
+HOST = '127.0.0.1'
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_server(port, client_port, scenario):
+    reader = SyntheticVideoReader(scenario['frames'], scenario['width'], scenario['height'], scenario['objects'],
+                                  scenario['seed'])
+    server = StubDetectionServer(HOST, port, HOST, client_port, reader, scenario['detector_delay'])
+    server.start()
+
+
+def run_client(port, server_port, scenario, results):
+    import client
+    import tracing
+    from metrics import REGISTRY
+    reader = SyntheticVideoReader(scenario['frames'], scenario['width'], scenario['height'], scenario['objects'],
+                                  scenario['seed'])
+    latency_tracer = tracing.LatencyTracer(export_interval=float('inf'))
+    object_tracker = client.ObjectTrackerClient(
+        HOST, port, HOST, server_port, None, scenario['frame_rate'], None, latency_tracer=latency_tracer,
+        video_reader=reader, model_path=None, max_tracks=scenario['objects'], frame_diff_threshold=0,
+        min_key_frame_distance=scenario['key_frame_distance'])
+    object_tracker.start()
+    # from the first frame read, the connection handshake is not part of the run
+    wall = time.time() - reader.first_read_time
+    metrics = REGISTRY.to_dict()
+    tracker = metrics.get('tracker_seconds', {'count': 0, 'sum': 0})
+    results.put({
+        'frames': metrics.get('frames_tracked', 0),
+        'key_frames': metrics.get('key_frames_sent', 0),
+        'replies': metrics.get('replies_received', 0),
+        'bytes_sent': metrics.get('bytes_sent', 0),
+        'wall_seconds': wall,
+        'tracker_ms_mean': tracker['sum'] * 1000 / max(tracker['count'], 1),
+        'latency_ms': latency_tracer.summary(),
+    })
+    results.close()
+    results.join_thread()
+    # the receiver threads never return
+    os._exit(0)
+
+
+def run_scenario(scenario, timeout):
+    port = free_port()
+    server_port = free_port()
+    # the ports each side connects to, those of the proxies in front of the other side with a link latency
+    client_port_seen, server_port_seen = port, server_port
+    proxies = []
+    if scenario['link_latency'] > 0:
+        client_port_seen, server_port_seen = free_port(), free_port()
+        proxies = [DelayProxy(HOST, server_port_seen, HOST, server_port, scenario['link_latency']),
+                   DelayProxy(HOST, client_port_seen, HOST, port, scenario['link_latency'])]
+        for proxy in proxies:
+            proxy.start()
+    results = multiprocessing.Queue()
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server_process = multiprocessing.Process(target=run_server, args=(server_port, client_port_seen, scenario),
+                                             daemon=True)
+    client_process = multiprocessing.Process(target=run_client, args=(port, server_port_seen, scenario, results))
+    server_process.start()
+    client_process.start()
+    try:
+        result = results.get(timeout=timeout)
+    finally:
+        client_process.join(5)
+        for process in (client_process, server_process):
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for proxy in proxies:
+            proxy.close()
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    result['fps'] = result['frames'] / max(result['wall_seconds'], 1e-9)
+    result['cpu_ms_per_frame'] = cpu * 1000 / max(result['frames'], 1)
+    end_to_end = result['latency_ms'].get('end_to_end')
+    result['end_to_end_ms'] = end_to_end
+    return result
+
+
+def build_scenarios(args):
+    for objects, resolution, link_latency, key_frame_distance in itertools.product(
+            args.objects, args.resolutions, args.link_latency, args.key_frame_distance):
+        width, height = (int(item) for item in resolution.split('x'))
+        yield {
+            'objects': objects,
+            'width': width,
+            'height': height,
+            'link_latency': link_latency,
+            'key_frame_distance': key_frame_distance,
+            'detector_delay': args.detector_delay,
+            'frame_rate': args.frame_rate,
+            'frames': args.frames,
+            'seed': args.seed,
+        }
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='End-to-end pipeline benchmark.')
+    parser.add_argument('-objects', type=int, nargs='+', default=[1, 4], help='Objects per video')
+    parser.add_argument('-resolutions', type=str, nargs='+', default=['640x360', '1280x720'], help='WxH')
+    parser.add_argument('-link_latency', type=float, nargs='+', default=[0.0], help='One-way link latency, seconds')
+    parser.add_argument('-key_frame_distance', type=float, nargs='+', default=[0.1, 0.5],
+                        help='Minimum seconds between key frames')
+    parser.add_argument('-detector_delay', type=float, default=0.05, help='Stub detector time, seconds')
+    parser.add_argument('-frame_rate', type=int, default=30, help='Video FPS')
+    parser.add_argument('-frames', type=int, default=150, help='Frames per video')
+    parser.add_argument('-seed', type=int, default=0, help='Synthetic video seed')
+    parser.add_argument('-timeout', type=float, default=600, help='Seconds before a scenario is abandoned')
+    parser.add_argument('-out', type=str, default=None, help='JSON output path, stdout if not set')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    runs = []
+    for scenario in build_scenarios(args):
+        runs.append({'scenario': scenario, 'result': run_scenario(scenario, args.timeout)})
+    report = json.dumps({'revision': git_revision(), 'time': time.time(), 'runs': runs}, indent=2)
+    if args.out is None:
+        print(report)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(report)
@@ -0,0 +1,163 @@
+"""
+Synthetic video with moving boxes, a stand-in detection server that answers with their ground truth and a
+proxy adding link latency to the sockets between the client and the server.
+"""
+import socket
+import threading
+import time
+from queue import Queue
+import numpy as np
+
+from frame_utils import Frame, VideoReader
+from object_transmission import DetectedObjects, DetectedObject
+from server import ObjectDetectionServer
+
+
+PROXY_BUFFER_SIZE = 65536
+CONNECT_RETRY = 0.1     # seconds between attempts to reach the target of a proxied connection
+
+
+class SyntheticVideoReader(VideoReader):
+    """
+    Solid colored boxes bouncing over a fixed noise background. Frames are generated on demand and the
+    box positions are a closed form of frame_seq, so any frame and its ground truth can be reproduced
+    from the seed alone, e.g. by the stub server.
+    """
+    def __init__(self, num_frames, width=640, height=360, num_objects=1, seed=0, speed=4.0):
+        self.num_frames = num_frames
+        self.width = width
+        self.height = height
+        self.current_frame_seq = 0
+        self.first_read_time = None
+        rng = np.random.default_rng(seed)
+        self.background = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        self.colors = rng.integers(0, 256, size=(num_objects, 3), dtype=np.uint8)
+        sizes = rng.uniform(0.1, 0.25, size=(num_objects, 1)) * min(width, height)
+        self.sizes = np.concatenate((sizes, sizes * rng.uniform(0.7, 1.4, size=(num_objects, 1))), axis=1)
+        self.ranges = np.array([width, height], dtype=np.float64) - self.sizes
+        self.starts = rng.uniform(0, 1, size=(num_objects, 2)) * self.ranges
+        self.velocities = rng.uniform(-1, 1, size=(num_objects, 2)) * speed
+
+    # @return{ndarray Nx4} xyxy ground truth boxes of frame_seq.
+    def boxes(self, frame_seq):
+        # positions bounce between 0 and the range, i.e. a triangle wave
+        position = np.mod(self.starts + self.velocities * frame_seq, 2 * self.ranges)
+        position = np.where(position > self.ranges, 2 * self.ranges - position, position)
+        return np.concatenate((position, position + self.sizes), axis=1)
+
+    def get_frame(self, frame_seq):
+        image = self.background.copy()
+        for (x1, y1, x2, y2), color in zip(np.round(self.boxes(frame_seq)).astype(int), self.colors):
+            image[y1:y2, x1:x2] = color
+        return Frame(image, list(image.shape), frame_seq)
+
+    def next_frame(self):
+        if self.first_read_time is None:
+            self.first_read_time = time.time()
+        frame = self.get_frame(self.current_frame_seq)
+        self.current_frame_seq += 1
+        return frame
+
+    def has_next(self):
+        return self.current_frame_seq < self.num_frames
+
+
+class StubDetectionServer(ObjectDetectionServer):
+    """
+    ObjectDetectionServer that skips the detector and replies with the ground truth of a synthetic video,
+    or of the stream_id-th of a list of them, after delay seconds.
+    """
+    def __init__(self, host, port, client_host, client_port, video_reader, delay=0.0):
+        super().__init__(host, port, client_host, client_port)
+        self.video_reader = video_reader
+        self.delay = delay
+
+    def load_model(self):
+        return None
+
+    def warmup(self):
+        pass
+
+    def detect_object(self, frame):
+        time.sleep(self.delay)
+        video_reader = self.video_reader
+        if isinstance(video_reader, list):
+            video_reader = video_reader[frame.stream_id]
+        boxes = video_reader.boxes(frame.frame_seq)
+        if frame.rois:
+            # only the objects centered in one of the regions are visible to the detector
+            centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+            visible = np.zeros(len(boxes), dtype=bool)
+            for x1, y1, x2, y2 in (roi.bbox for roi in frame.rois):
+                visible |= (centers[:, 0] >= x1) & (centers[:, 0] < x2) & (centers[:, 1] >= y1) & (centers[:, 1] < y2)
+            boxes = boxes[visible]
+        objects = [DetectedObject(1, [float(item) for item in bbox], 1.0) for bbox in boxes]
+        return DetectedObjects(frame.frame_seq, objects, frame.timestamps, frame.stream_id)
+
+
+class DelayProxy:
+    """
+    Forwards the TCP connections made to port on to target_port, each chunk delivered latency seconds after it
+    was read, in both directions. Every metadata, ack and reply exchange through it pays the round trip of a
+    remote link, the bandwidth is not limited. Connections made before the target listens wait for it.
+    """
+    def __init__(self, host, port, target_host, target_port, latency):
+        self.host = host
+        self.port = port
+        self.target_host = target_host
+        self.target_port = target_port
+        self.latency = latency
+        self.server_socket = None
+
+    def start(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(10)
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.forward, args=(client_socket,), daemon=True).start()
+
+    def forward(self, client_socket):
+        while True:
+            try:
+                target_socket = socket.create_connection((self.target_host, self.target_port))
+                break
+            except OSError:
+                time.sleep(CONNECT_RETRY)
+        for source, destination in ((client_socket, target_socket), (target_socket, client_socket)):
+            chunks = Queue()
+            threading.Thread(target=self.read, args=(source, chunks), daemon=True).start()
+            threading.Thread(target=self.write, args=(destination, chunks), daemon=True).start()
+
+    def read(self, sock, chunks):
+        while True:
+            try:
+                data = sock.recv(PROXY_BUFFER_SIZE)
+            except OSError:
+                data = b''
+            chunks.put((time.time() + self.latency, data))
+            if not data:
+                return
+
+    def write(self, sock, chunks):
+        while True:
+            due, data = chunks.get()
+            time.sleep(max(0.0, due - time.time()))
+            try:
+                if not data:
+                    # the other side closed, so does this one once the data before has arrived
+                    sock.shutdown(socket.SHUT_WR)
+                    return
+                sock.sendall(data)
+            except OSError:
+                return
+
+    def close(self):
+        self.server_socket.close()
@@ -1,110 +1,313 @@
 import argparse
+import logging
+from collections import deque
 from queue import Queue
-from frame_transmission import FrameTransmissionSender
+from frame_transmission import FrameTransmissionSender, SharedMemoryFrameSender, FrameSenderPool, RESPONSE_TIMEOUT
 from object_transmission import ObjectTransmissionReceiver, DetectedObjects, DetectedObject
 import threading
 import time
 import frame_utils
 from frame_utils import Frame
-from tracker.re3_tracker import Re3Tracker
+import tracing
+import metrics
+from metrics import REGISTRY
+import profiling
+import resources
+from resources import ResourceConfig
+from tracker.association import TrackAssociator
 import cv2
+import numpy as np
 import os
 
 
 MAX_OBJ_TRACK_NUM = 1
 FRAME_DIFF_THRESHOLD = 4500000
 MIN_KEY_FRAME_DISTANCE = 0.1    # seconds
+ROI_PADDING = 2                 # detection crops are this many times the size of the track box
+FULL_FRAME_REFRESH_INTERVAL = 10    # every n-th key frame is sent in full to pick up new objects
+
+logger = logging.getLogger(__name__)
+
+frames_read = REGISTRY.counter('frames_read', 'Frames read from the video')
+frames_tracked = REGISTRY.counter('frames_tracked', 'Frames run through the tracker')
+replies_superseded = REGISTRY.counter('replies_superseded', 'Detection replies skipped for a newer one')
+video_buffer_depth = REGISTRY.gauge('video_buffer_depth', 'Frames waiting to be tracked')
+object_queue_depth = REGISTRY.gauge('object_queue_depth', 'Detection replies waiting to be applied')
+track_count = REGISTRY.gauge('tracks', 'Live tracks')
+time_to_first_detection = REGISTRY.gauge('time_to_first_detection_seconds',
+                                         'Seconds from start until the first detection is applied')
+tracker_seconds = REGISTRY.histogram('tracker_seconds', 'Tracker time per tick for the tracks of all streams')
+
+
+class VideoStream:
+    """One video of the client, with its own key frame logic, frames awaiting detection and tracks."""
+    def __init__(self, stream_id, video_path, frame_rate, output, video_reader=None, max_tracks=MAX_OBJ_TRACK_NUM,
+                 frame_diff_threshold=FRAME_DIFF_THRESHOLD, min_key_frame_distance=MIN_KEY_FRAME_DISTANCE):
+        self.stream_id = stream_id
+        self.video_path = video_path
+        self.frame_rate = frame_rate
+        self.output_path = output  # None to skip writing the tracked frames
+        self.video_reader = video_reader
+        self.key_frame_selector = frame_utils.KeyFrameSelector(frame_rate, frame_diff_threshold,
+                                                               min_key_frame_distance)
+        self.associator = TrackAssociator(max_tracks)
+        self.ready_frames = deque()     # read but not tracked yet
+        self.replies = []               # detection replies not applied yet
+        self.sent_frames = {}           # frame_seq -> (key frame, track boxes when it was sent)
+        self.frame_cache = []           # frames since the last reply, replayed for re-initialized tracks
+        self.key_frame_cnt = 0
+        self.applied_seq = -1           # replies are applied in frame_seq order, older ones are dropped
+        self.finished = False
+
+    # Ids of the tracks in the tracker, which is shared by all streams.
+    def tracker_ids(self, tracks):
+        return [(self.stream_id, track.id) for track in tracks]
 
 
 class ObjectTrackerClient:
-    def __init__(self, host, port, server_host, server_port, video_path, frame_rate, output):
+    """
+    Tracks one or more videos, added with add_stream, over a single connection to the server, or spread over
+    a pool of servers given as (host, port) pairs. The tracks of all streams with a new frame are run through
+    one Re3 forward pass per tick.
+    """
+    def __init__(self, host, port, server_host, server_port, video_path, frame_rate, output, encoding_profile=None,
+                 transport='tcp', latency_tracer=None, video_reader=None, model_path='checkpoint.pth',
+                 max_tracks=MAX_OBJ_TRACK_NUM, frame_diff_threshold=FRAME_DIFF_THRESHOLD,
+                 min_key_frame_distance=MIN_KEY_FRAME_DISTANCE, profiler=None, warmup_runs=None,
+                 servers=None, resources=None, response_timeout=RESPONSE_TIMEOUT):
         self.host = host
         self.port = port
         self.server_host = server_host
         self.server_port = server_port
-        self.video_path = video_path
-        self.frame_rate = frame_rate
-        self.output_path = output
-        self.video_buffer = Queue()
+        self.model_path = model_path
+        self.warmup_runs = warmup_runs
+        self.max_tracks = max_tracks
+        self.frame_diff_threshold = frame_diff_threshold
+        self.min_key_frame_distance = min_key_frame_distance
+        self.streams = []
+        if video_path is not None or video_reader is not None:
+            self.add_stream(video_path, frame_rate, output, video_reader)
+        self.video_buffer = Queue()     # (stream, frame) of all streams, frame None at the end of a video
         self.object_queue = Queue()
-        self.frame_sender = FrameTransmissionSender(self.server_host, self.server_port)
+        if servers is None:
+            self.frame_sender = self.create_sender(self.server_host, self.server_port, transport, encoding_profile)
+        else:
+            # each link adapts its own quality and scale to its throughput
+            self.frame_sender = FrameSenderPool([self.create_sender(server_host, server_port, transport,
+                                                                    encoding_profile and encoding_profile.copy())
+                                                 for server_host, server_port in servers], response_timeout)
         self.object_receiver = ObjectTransmissionReceiver(self.host, self.port, self.object_queue)
         self.client_thread = None
-        self.video_thread = None
-        self.trackers = None
+        self.video_threads = []
+        self.tracker = None
+        self.streaming = threading.Event()   # set once the tracker and the server are ready for frames
+        self.start_time = None
+        self.first_detection_time = None
+        if latency_tracer is None:
+            latency_tracer = tracing.LatencyTracer()
+        self.latency_tracer = latency_tracer
+        if profiler is None:
+            profiler = profiling.Profiler()
+        self.profiler = profiler
+        if resources is None:
+            resources = ResourceConfig()
+        self.resources = resources
+
+    @staticmethod
+    def create_sender(server_host, server_port, transport, encoding_profile):
+        if transport == 'shm':
+            return SharedMemoryFrameSender(server_host, server_port)
+        return FrameTransmissionSender(server_host, server_port, encoding_profile)
+
+    def add_stream(self, video_path, frame_rate, output, video_reader=None):
+        stream = VideoStream(len(self.streams), video_path, frame_rate, output, video_reader, self.max_tracks,
+                             self.frame_diff_threshold, self.min_key_frame_distance)
+        self.streams.append(stream)
+        return stream
 
     def start(self):
+        # the tracker loads and the videos are indexed while connecting to the server, the first frame is
+        # read once all of it is done
+        self.start_time = time.time()
+        prepare_thread = threading.Thread(target=self.prepare, name='prepare')
+        prepare_thread.start()
+        for stream in self.streams:
+            video_thread = threading.Thread(target=self.video_sim_loop, args=(stream,),
+                                            name=f'video_sim_loop-{stream.stream_id}')
+            video_thread.start()
+            self.video_threads.append(video_thread)
         self.object_receiver.start()
-        print('Waiting for server...')
+        logger.info('Waiting for server...')
         while True:
             if self.frame_sender.connect():
-                print('Connected to server.')
+                logger.info('Connected to server.')
                 break
             time.sleep(2)
-        self.client_thread = threading.Thread(target=self.client_loop)
+        prepare_thread.join()
+        if self.tracker is None:
+            raise Exception('Tracker failed to load.')
+        self.client_thread = threading.Thread(target=self.client_loop, name='client_loop')
         self.client_thread.start()
-        self.video_thread = threading.Thread(target=self.video_sim_loop)
-        self.video_thread.start()
+        self.streaming.set()
         self.client_thread.join()
 
+    def prepare(self):
+        self.resources.enter('tracker')
+        # torch is imported here rather than with the module, so -h and the socket setup do not wait for it
+        from tracker.re3_tracker import Re3Tracker
+        self.tracker = Re3Tracker(self.model_path)
+        self.tracker.warmup(self.warmup_runs)
+        metrics.startup_seconds.set(time.time() - self.start_time)
+        metrics.ready.set(1)
+        logger.info('Ready in %.1fs.', time.time() - self.start_time)
+
+    def buffer_frame(self, item):
+        stream, frame = item
+        if frame is None:   # end of the video
+            stream.finished = True
+        else:
+            stream.ready_frames.append(frame)
+
+    # Waits until a stream has a frame, then takes the oldest ready frame of every stream.
+    # @return{list} (stream, frame) pairs, at most one per stream.
+    def next_frames(self):
+        if not any(stream.ready_frames for stream in self.streams):
+            self.buffer_frame(self.video_buffer.get())
+        while not self.video_buffer.empty():
+            self.buffer_frame(self.video_buffer.get())
+        video_buffer_depth.set(sum(len(stream.ready_frames) for stream in self.streams))
+        return [(stream, stream.ready_frames.popleft()) for stream in self.streams if stream.ready_frames]
+
+    def send_key_frame(self, stream, frame):
+        # send to server, as crops around the tracks except for periodic full-frame refreshes, the sender
+        # may hold the frame back until the server grants a credit
+        stream.key_frame_cnt += 1
+        with self.profiler.span('send'):
+            tracks = stream.associator.tracks
+            if tracks and stream.key_frame_cnt % FULL_FRAME_REFRESH_INTERVAL != 0:
+                track_boxes = np.stack([track.bbox for track in tracks], axis=1)
+                frame.rois = frame_utils.crop_rois(frame.image, track_boxes, ROI_PADDING)
+            self.frame_sender.send(frame)
+        stream.sent_frames[frame.frame_seq] = (frame, stream.associator.snapshot())
+
+    def apply_replies(self, stream):
+        # associate the newest detections with the tracks
+        objects = None
+        for obj in stream.replies:
+            if objects is not None:
+                replies_superseded.inc()
+            if objects is None or objects.frame_seq < obj.frame_seq:
+                objects = obj
+        key_frame, key_boxes = stream.sent_frames[objects.frame_seq]
+        # older key frames were superseded on either side and will get no reply
+        for frame_seq in [frame_seq for frame_seq in stream.sent_frames if frame_seq <= objects.frame_seq]:
+            del stream.sent_frames[frame_seq]
+        stream.replies.clear()
+        stream.applied_seq = objects.frame_seq
+        with self.profiler.span('associate'):
+            result = stream.associator.update(objects.objects, key_boxes)
+        for track in result.retired:
+            self.tracker.remove((stream.stream_id, track.id))
+        # only drifted and new tracks are re-initialized and replayed
+        reinit_tracks = result.reseeded + result.spawned
+        with self.profiler.span('replay'):
+            replay_ids = stream.tracker_ids(reinit_tracks)
+            for tracker_id, track in zip(replay_ids, reinit_tracks):
+                self.tracker.track(tracker_id, key_frame.image, bbox=track.bbox)
+            for cached_frame in stream.frame_cache:
+                if cached_frame.frame_seq <= objects.frame_seq or not replay_ids:
+                    continue
+                bboxes = self.tracker.track_batch(replay_ids, cached_frame.image)
+                for i, track in enumerate(reinit_tracks):
+                    track.bbox = bboxes[:, i]
+        stream.frame_cache.clear()
+        tracing.mark(objects.timestamps, 'applied')
+        self.latency_tracer.record(objects.timestamps)
+        if self.first_detection_time is None:
+            self.first_detection_time = time.time() - self.start_time
+            time_to_first_detection.set(self.first_detection_time)
+            logger.info('First detection applied %.2fs after start.', self.first_detection_time)
+
+    def track_frames(self, frames):
+        # one forward pass for the tracks of all streams
+        tracker_ids = []
+        images = []
+        tracks = []
+        for stream, frame in frames:
+            stream_tracks = stream.associator.tracks
+            tracker_ids += stream.tracker_ids(stream_tracks)
+            images += [frame.image] * len(stream_tracks)
+            tracks += stream_tracks
+        if tracks:
+            with tracker_seconds.time():
+                bboxes = self.tracker.track_batch(tracker_ids, images)
+            for i, track in enumerate(tracks):
+                track.bbox = bboxes[:, i]
+
+    # Takes the replies received so far, their grants are passed on to the sender right away.
+    def receive_replies(self):
+        while not self.object_queue.empty():
+            objects: DetectedObjects = self.object_queue.get()
+            stream = self.streams[objects.stream_id]
+            if objects.failed:
+                # no detections to apply, the reply only returns the credit of the frame
+                logger.warning('Detection of frame #%d of stream %d failed on the server.',
+                               objects.frame_seq, objects.stream_id)
+            elif objects.frame_seq > stream.applied_seq:
+                stream.replies.append(objects)
+            else:   # a pooled server answered after a newer key frame was applied
+                replies_superseded.inc()
+            with self.profiler.span('send'):
+                self.frame_sender.on_reply(objects)
+
     def client_loop(self):
-        first_frame: Frame = self.video_buffer.get()
-        self.frame_sender.send(first_frame)
-        first_objects: DetectedObjects = self.object_queue.get()
-        self.trackers = [Re3Tracker() for _ in range(MAX_OBJ_TRACK_NUM)]
-        for i, tracker in enumerate(self.trackers):
-            tracker.track(1, first_frame.image, bbox=first_objects.objects[i].bbox)
-        last_frame_sent = first_frame
-        frame_cnt = 0
-        frame_cache = []
-        sent_frames = {}
-        while True:
+        self.resources.enter('tracker')
+        while not all(stream.finished and not stream.ready_frames for stream in self.streams):
             try:
-                frame: Frame = self.video_buffer.get()
-                frame_cnt += 1
-                diff = frame_utils.diff_img(last_frame_sent.image, frame.image)
-                print(f'diff between #{last_frame_sent.frame_seq} and #{frame.frame_seq} is {diff}')
-                if diff > FRAME_DIFF_THRESHOLD and frame_cnt * (1 / self.frame_rate) > MIN_KEY_FRAME_DISTANCE:
-                    # send to server
-                    frame_cnt = 0
-                    self.frame_sender.send(frame)
-                    sent_frames[frame.frame_seq] = frame
-                    last_frame_sent = frame
-                if not self.object_queue.empty():   # reset the trackers
-                    max_seq = -1
-                    objects = None
-                    key_frame = None
-                    while not self.object_queue.empty():
-                        obj = self.object_queue.get()
-                        if max_seq < obj.frame_seq:
-                            max_seq = obj.frame_seq
-                            objects = obj
-                            key_frame = sent_frames[obj.frame_seq]
-                        del sent_frames[obj.frame_seq]
-                    for i, tracker in enumerate(self.trackers):
-                        tracker.track(1, key_frame.image, bbox=objects.objects[i].bbox)
-                    for cached_frame in frame_cache:
-                        if cached_frame.frame_seq <= objects.frame_seq:
-                            continue
-                        for i, tracker in enumerate(self.trackers):
-                            tracker.track(1, cached_frame.image)
-                    frame_cache.clear()
-                else:
-                    frame_cache.append(frame)
-                    frame_image = frame.image.copy()
-                    for i, tracker in enumerate(self.trackers):
-                        bbox = tracker.track(1, frame)
-                        frame_image = frame_utils.draw_bbox(frame_image, bbox, i)
-                    cv2.imwrite(os.path.join(self.output_path, f'{str(frame.frame_seq)}.JPEG'), frame_image)
+                frames = self.next_frames()
+                self.profiler.tick(torch_ops=True)
+                object_queue_depth.set(self.object_queue.qsize())
+                self.receive_replies()
+                key_frames = []
+                for stream, frame in frames:
+                    with self.profiler.span('diff'):
+                        if stream.key_frame_selector.is_key_frame(frame):
+                            key_frames.append((stream, frame))
+                    if stream.replies:
+                        self.apply_replies(stream)
+                    stream.frame_cache.append(frame)
+                with self.profiler.span('track'):
+                    self.track_frames(frames)
+                # key frames are sent once tracked, so their crops and track boxes are those of the frame itself,
+                # after the replies that came in meanwhile, so a pool does not take a long tick for a dead server
+                if key_frames:
+                    self.receive_replies()
+                for stream, frame in key_frames:
+                    self.send_key_frame(stream, frame)
+                frames_tracked.inc(len(frames))
+                track_count.set(sum(len(stream.associator.tracks) for stream in self.streams))
+                for stream, frame in frames:
+                    if stream.output_path is not None:
+                        frame_image = frame.image.copy()
+                        for track in stream.associator.tracks:
+                            frame_image = frame_utils.draw_bbox(frame_image, track.bbox, track.id)
+                        cv2.imwrite(os.path.join(stream.output_path, f'{str(frame.frame_seq)}.JPEG'), frame_image)
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception as ex:
-                pass
+                logger.exception(ex)
 
-    def video_sim_loop(self):
-        video_reader = frame_utils.DirectoryVideoReader(self.video_path)
-        for frame in frame_utils.video_stream(video_reader, self.frame_rate):
-            self.video_buffer.put(frame)
+    def video_sim_loop(self, stream):
+        self.resources.enter('codec')
+        video_reader = stream.video_reader
+        if video_reader is None:
+            video_reader = frame_utils.DirectoryVideoReader(stream.video_path)
+        self.streaming.wait()
+        for frame in frame_utils.video_stream(video_reader, stream.frame_rate):
+            frame.stream_id = stream.stream_id
+            frames_read.inc()
+            self.video_buffer.put((stream, frame))
+        self.video_buffer.put((stream, None))
 
 
 # client program arguments
@@ -112,11 +315,33 @@ def build_arg_parser():
     parser = argparse.ArgumentParser(description='Server process.')
     parser.add_argument('-host', type=str, required=True, help='Client host')
     parser.add_argument('-port', type=int, required=True, help='Client port')
-    parser.add_argument('-server_host', type=str, required=True, help='Server host')
-    parser.add_argument('-server_port', type=int, required=True, help='Server port')
-    parser.add_argument('-video_path', type=str, required=True, help='Video Path')
+    parser.add_argument('-server_host', type=str, default=None, help='Server host')
+    parser.add_argument('-server_port', type=int, default=None, help='Server port')
+    parser.add_argument('-servers', type=str, nargs='+', default=None,
+                        help='host:port of several servers to balance key frames over, instead of -server_host')
+    parser.add_argument('-response_timeout', type=float, default=RESPONSE_TIMEOUT,
+                        help='Seconds a pooled server may take to reply, at least, before it is considered dead')
+    parser.add_argument('-video_path', type=str, nargs='+', required=True,
+                        help='Video Path, several to track them all in this process')
     parser.add_argument('-frame_rate', type=int, required=True, help='Video FPS')
-    parser.add_argument('-out', type=str, required=True, help='Output Path')
+    parser.add_argument('-out', type=str, required=True,
+                        help='Output Path, with a subdirectory per stream for several videos')
+    parser.add_argument('-model', type=str, default='checkpoint.pth', help='Re3 checkpoint path')
+    parser.add_argument('-warmup_runs', type=int, default=None, help='Tracker runs on a blank image at start')
+    parser.add_argument('-jpeg_quality', type=int, default=95, help='Key frame JPEG quality')
+    parser.add_argument('-jpeg_scale', type=float, default=1.0, help='Key frame downscale factor')
+    parser.add_argument('-adaptive_encoding', action='store_true',
+                        help='Adapt JPEG quality and scale to the measured link throughput')
+    parser.add_argument('-fast_encode', action='store_true', help='Favor encode speed over frame size')
+    parser.add_argument('-transport', type=str, default='tcp', choices=['tcp', 'shm'],
+                        help='Frame transport, shm passes raw frames through shared memory to a server on this host')
+    parser.add_argument('-latency_interval', type=float, default=10.0,
+                        help='Seconds between exports of the per-stage latency percentiles')
+    parser.add_argument('-latency_out', type=str, default=None,
+                        help='File the latency percentiles are appended to as JSON lines, stdout if not set')
+    metrics.add_arguments(parser)
+    profiling.add_arguments(parser)
+    resources.add_arguments(parser)
     return parser
 
 
@@ -124,8 +349,28 @@ if __name__ == '__main__':
     try:
         arg_parser = build_arg_parser()
         args = arg_parser.parse_args()  # parse arguments
-        object_tracker = ObjectTrackerClient(args.host, args.port, args.server_host, args.server_port, args.video_path,
-                                             args.frame_rate, args.out)
+        servers = None
+        if args.servers is not None:
+            servers = [(server.rsplit(':', 1)[0], int(server.rsplit(':', 1)[1])) for server in args.servers]
+        elif args.server_host is None or args.server_port is None:
+            arg_parser.error('-server_host and -server_port, or -servers, are required')
+        metrics.configure(args)
+        profiler = profiling.configure(args)
+        resource_config = resources.configure(args)
+        encoding_profile = frame_utils.EncodingProfile(args.jpeg_quality, args.jpeg_scale, args.fast_encode,
+                                                       args.adaptive_encoding)
+        object_tracker = ObjectTrackerClient(args.host, args.port, args.server_host, args.server_port, None,
+                                             args.frame_rate, None, encoding_profile, args.transport,
+                                             tracing.LatencyTracer(args.latency_interval, args.latency_out),
+                                             model_path=args.model, profiler=profiler, warmup_runs=args.warmup_runs,
+                                             servers=servers, resources=resource_config,
+                                             response_timeout=args.response_timeout)
+        for stream_id, video_path in enumerate(args.video_path):
+            output = args.out
+            if len(args.video_path) > 1:
+                output = os.path.join(args.out, str(stream_id))
+                os.makedirs(output, exist_ok=True)
+            object_tracker.add_stream(video_path, args.frame_rate, output)
         object_tracker.start()
     except Exception as e:
-        print(e)
+        logger.exception(e)
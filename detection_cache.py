@@ -0,0 +1,132 @@
+import itertools
+import logging
+import time
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+import tracing
+from object_transmission import DetectedObjects
+from metrics import REGISTRY
+
+
+THUMBNAIL_SIZE = (32, 32)
+CACHE_TOLERANCE = 8.0   # largest difference of any pixel of the gray thumbnails, in gray levels
+CACHE_SIZE = 8          # entries per stream, 0 disables the cache
+CACHE_TTL = 30.0        # seconds a detection may be reused after it was run
+ROI_MIN_OVERLAP = 0.9   # intersection over union of the areas two frames sent as crops cover to be compared
+
+logger = logging.getLogger(__name__)
+
+cache_hits = REGISTRY.counter('detection_cache_hits', 'Key frames answered with a cached detection')
+cache_misses = REGISTRY.counter('detection_cache_misses', 'Key frames run through the detector')
+cache_evictions = REGISTRY.counter('detection_cache_evictions', 'Cached detections dropped for age or space')
+cache_hit_rate = REGISTRY.gauge('detection_cache_hit_rate', 'Fraction of cacheable key frames answered from cache')
+
+
+# Perceptual signature of a frame, a small gray thumbnail.
+def thumbnail(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+# Signature of a frame sent as region crops, the thumbnail of its crops pasted at their place in a blank frame
+#   and the fraction of each thumbnail pixel they cover.
+# @return{tuple} (thumbnail, coverage).
+def roi_thumbnail(frame):
+    height, width = frame.size[:2]
+    canvas = np.zeros((height, width), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.float32)
+    for roi in frame.rois:
+        x1, y1, x2, y2 = (int(round(item)) for item in roi.bbox)
+        gray = cv2.cvtColor(roi.image, cv2.COLOR_BGR2GRAY)
+        if gray.shape != (y2 - y1, x2 - x1):
+            # the client downscaled the crop
+            gray = cv2.resize(gray, (x2 - x1, y2 - y1), interpolation=cv2.INTER_LINEAR)
+        canvas[y1:y2, x1:x2] = gray
+        mask[y1:y2, x1:x2] = 1
+    return (cv2.resize(canvas, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32),
+            cv2.resize(mask, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA))
+
+
+# Largest pixel difference of two crop signatures, over the pixels inside the crops of both: the edges of regions
+#   that followed a track by a pixel mix in the blank frame. Infinite unless the crops cover about the same part
+#   of the frame, the detections only cover the regions.
+def roi_difference(signature, other_signature):
+    (thumbnail_a, coverage_a), (thumbnail_b, coverage_b) = signature, other_signature
+    overlap = np.minimum(coverage_a, coverage_b).sum() / max(float(np.maximum(coverage_a, coverage_b).sum()), 1e-9)
+    # the area resize leaves rounding errors in the coverage of whole pixels
+    inside = np.minimum(coverage_a, coverage_b) > 0.999
+    if overlap < ROI_MIN_OVERLAP or not inside.any():
+        return float('inf')
+    return float(np.max(np.abs(thumbnail_a - thumbnail_b)[inside]))
+
+
+class DetectionCache:
+    """
+    Reuses the detections of a recent key frame of the same stream whose thumbnail differs from the new one by
+    less than tolerance in every pixel: a moving object changes a few pixels a lot, while noise and compression
+    change all of them a little. Entries expire ttl seconds after their detection ran and the least recently
+    used are evicted beyond size per stream. Frames sent as region crops are only compared with each other, see
+    roi_difference.
+    """
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, tolerance=CACHE_TOLERANCE):
+        self.size = size
+        self.ttl = ttl
+        self.tolerance = tolerance
+        self.entries = {}   # stream_id -> OrderedDict of key -> (thumbnail, layout, objects, detection time)
+        self.key_counter = itertools.count()
+        self.hits = 0
+        self.lookups = 0
+
+    def expire(self, entries, now):
+        for key, (_, _, _, detected_at) in list(entries.items()):
+            if now - detected_at > self.ttl:
+                del entries[key]
+                cache_evictions.inc()
+
+    # @layout{tuple} frame size and whether the frame was sent as crops, only frames of the same are compared.
+    def lookup(self, entries, signature, layout):
+        best_key = None
+        best_diff = self.tolerance
+        for key, (cached_signature, cached_layout, _, _) in entries.items():
+            if cached_layout != layout:
+                continue
+            if layout[1]:
+                diff = roi_difference(cached_signature, signature)
+            else:
+                diff = float(np.max(np.abs(cached_signature - signature)))
+            if diff < best_diff:
+                best_key = key
+                best_diff = diff
+        return best_key
+
+    # Detections of the frame, from a near-duplicate earlier key frame or else from detector(frame).
+    def detect(self, frame, detector):
+        if self.size <= 0:
+            return detector(frame)
+        now = time.time()
+        entries = self.entries.setdefault(frame.stream_id, OrderedDict())
+        self.expire(entries, now)
+        signature = roi_thumbnail(frame) if frame.rois else thumbnail(frame.image)
+        layout = (tuple(frame.size), bool(frame.rois))
+        self.lookups += 1
+        key = self.lookup(entries, signature, layout)
+        if key is not None:
+            entries.move_to_end(key)
+            self.hits += 1
+            cache_hits.inc()
+            cache_hit_rate.set(self.hits / self.lookups)
+            logger.debug('Frame #%d of stream %d answered from cache.', frame.frame_seq, frame.stream_id)
+            tracing.mark(frame.timestamps, 'cache_hit')
+            objects = entries[key][2]
+            return DetectedObjects(frame.frame_seq, list(objects), frame.timestamps, frame.stream_id)
+        cache_misses.inc()
+        cache_hit_rate.set(self.hits / self.lookups)
+        detected_objects = detector(frame)
+        # copied, the sender sorts the list of the reply in place
+        entries[next(self.key_counter)] = (signature, layout, list(detected_objects.objects), now)
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+            cache_evictions.inc()
+        return detected_objects
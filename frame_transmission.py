@@ -1,15 +1,102 @@
 import json
+import logging
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
 import transmission
-from frame_utils import Frame
+from frame_utils import Frame, RegionOfInterest
 import frame_utils
+import tracing
+from metrics import REGISTRY, BYTES_BUCKETS
 
 
 METADATA_MESSAGE = 0
 METADATA_ACK_MESSAGE = 1
 IMAGE_ACK_MESSAGE = 2
+ROI_METADATA_MESSAGE = 3
+SHM_FRAME_MESSAGE = 4
+
+SHM_SLOTS = 8                 # slots per shared memory segment
+SERVER_CREDITS = 2            # frames per stream the server accepts before the earlier ones are done
+RESPONSE_TIMEOUT = 10.0       # seconds without an ack or reply before a pooled server is considered dead, at least
+RESPONSE_TIMEOUT_FACTOR = 4   # smoothed response times a slower server may take before it is considered dead
+REVIVE_BACKOFF = 1.0          # seconds before a dead server is reconnected, doubled on each failure
+MAX_REVIVE_BACKOFF = 30.0
+CONNECT_TIMEOUT = 5.0         # seconds a pooled server may take to accept a connection
+RESPONSE_TIME_SMOOTHING = 0.2
+CLOCK_SAMPLES = 8             # metadata round trips the clock offset of a server is estimated from
+
+logger = logging.getLogger(__name__)
+
+frames_received = REGISTRY.counter('frames_received', 'Frames received by the server')
+bytes_received = REGISTRY.counter('bytes_received', 'Frame bytes received by the server')
+frames_sent = REGISTRY.counter('key_frames_sent', 'Key frames sent by the client')
+bytes_sent = REGISTRY.counter('bytes_sent', 'Frame bytes sent by the client')
+frame_bytes_histogram = REGISTRY.histogram('frame_bytes', 'Bytes per sent key frame', BYTES_BUCKETS)
+encode_seconds = REGISTRY.histogram('encode_seconds', 'Key frame encode time')
+send_seconds = REGISTRY.histogram('send_seconds', 'Key frame send time until acknowledged')
+jpeg_quality = REGISTRY.gauge('jpeg_quality', 'JPEG quality of the last key frame')
+jpeg_scale = REGISTRY.gauge('jpeg_scale', 'Downscale factor of the last key frame')
+link_throughput = REGISTRY.gauge('link_throughput_bytes', 'Smoothed bytes per second to the server, round trip aside')
+frames_replaced = REGISTRY.counter('key_frames_replaced', 'Key frames replaced by a newer one while out of credits')
+frames_held = REGISTRY.gauge('key_frames_held', 'Streams with a key frame waiting for a credit')
+servers_alive = REGISTRY.gauge('servers_alive', 'Pooled detection servers currently connected')
+server_failures = REGISTRY.counter('server_failures', 'Pooled detection servers marked dead')
+
+
+class CreditLedger:
+    """
+    Server side of the flow control. A stream may have `credits` frames received but neither detected nor
+    dropped yet. Grants are cumulative, the number of frames of the stream the client may have sent so far,
+    so they stay valid however late they arrive.
+    """
+    def __init__(self, credits=SERVER_CREDITS):
+        self.credits = credits
+        self.completed = {}
+        self.lock = threading.Lock()
+
+    def complete(self, stream_id):
+        with self.lock:
+            self.completed[stream_id] = self.completed.get(stream_id, 0) + 1
+
+    def credit_limit(self, stream_id):
+        with self.lock:
+            return self.completed.get(stream_id, 0) + self.credits
 
 
 class FrameTransmissionReceiver(transmission.TransmissionReceiver):
+    def __init__(self, host, port, queue, credit_ledger=None):
+        super().__init__(host, port, queue)
+        self.shared_memories = {}
+        self.retired_memories = []
+        self.credit_ledger = credit_ledger
+
+    def image_ack(self, stream_id):
+        image_ack_message = {'type': IMAGE_ACK_MESSAGE}
+        if self.credit_ledger is not None:
+            image_ack_message['credit_limit'] = self.credit_ledger.credit_limit(stream_id)
+        return json.dumps(image_ack_message).encode()
+
+    # Closes segments the sender has unlinked, those still viewed by a queued frame on a later message.
+    def detach_shared_memory(self, names):
+        self.retired_memories += [self.shared_memories.pop(name) for name in names if name in self.shared_memories]
+        for memory in list(self.retired_memories):
+            try:
+                memory.close()
+                self.retired_memories.remove(memory)
+            except BufferError:
+                pass
+
+    def attach_shared_memory(self, name):
+        if name not in self.shared_memories:
+            memory = shared_memory.SharedMemory(name=name)
+            # the sender owns the segment, keep the resource tracker from unlinking it when we exit
+            resource_tracker.unregister(memory._name, 'shared_memory')
+            self.shared_memories[name] = memory
+        return self.shared_memories[name]
+
     def handle_data(self, sock, data):
         txt = data.decode()
         message = json.loads(txt)
@@ -18,17 +105,65 @@ class FrameTransmissionReceiver(transmission.TransmissionReceiver):
                 image_size = message['size']
                 bytes_size = message['bytes_size']
                 frame_seq = message['seq']
-                size_ack_message = {'type': METADATA_ACK_MESSAGE}
+                # the server clock, for the client to estimate the offset of the stages marked here
+                size_ack_message = {'type': METADATA_ACK_MESSAGE, 'time': time.time()}
                 sock.sendall(json.dumps(size_ack_message).encode())
 
                 # read the image
                 image_bytes = frame_utils.socket_recv_all(sock, bytes_size)
                 if not image_bytes:
                     raise Exception('No image received.')
-                image_ack_message = {'type': IMAGE_ACK_MESSAGE}
-                sock.sendall(json.dumps(image_ack_message).encode())
+                sock.sendall(self.image_ack(message.get('stream', 0)))
+                tracing.mark(message['timestamps'], 'received')
                 image = frame_utils.bytes_to_image(image_bytes)
-                frame = Frame(image, image_size, frame_seq)
+                tracing.mark(message['timestamps'], 'decoded')
+                frame = Frame(image, image_size, frame_seq, timestamps=message['timestamps'],
+                              stream_id=message.get('stream', 0))
+                frames_received.inc()
+                bytes_received.inc(bytes_size)
+                self.queue.put(frame)
+            elif message['type'] == ROI_METADATA_MESSAGE:
+                image_size = message['size']
+                bytes_sizes = message['bytes_sizes']
+                frame_seq = message['seq']
+                # the server clock, for the client to estimate the offset of the stages marked here
+                size_ack_message = {'type': METADATA_ACK_MESSAGE, 'time': time.time()}
+                sock.sendall(json.dumps(size_ack_message).encode())
+
+                # read the crops, sent back to back
+                rois_bytes = frame_utils.socket_recv_all(sock, sum(bytes_sizes))
+                if len(rois_bytes) != sum(bytes_sizes):
+                    raise Exception('Incomplete regions received.')
+                sock.sendall(self.image_ack(message.get('stream', 0)))
+                tracing.mark(message['timestamps'], 'received')
+                rois = []
+                start = 0
+                for bbox, bytes_size in zip(message['rois'], bytes_sizes):
+                    image = frame_utils.bytes_to_image(rois_bytes[start:start + bytes_size])
+                    rois.append(RegionOfInterest(bbox, image))
+                    start += bytes_size
+                tracing.mark(message['timestamps'], 'decoded')
+                frame = Frame(None, image_size, frame_seq, rois, message['timestamps'], message.get('stream', 0))
+                frames_received.inc()
+                bytes_received.inc(len(rois_bytes))
+                self.queue.put(frame)
+            elif message['type'] == SHM_FRAME_MESSAGE:
+                # the images are views of the sender's slots, nothing is copied or decoded
+                self.detach_shared_memory(message.get('retired', []))
+                memory = self.attach_shared_memory(message['shm'])
+                slot_size = message['slot_size']
+                images = [np.ndarray(shape, dtype=np.uint8, buffer=memory.buf, offset=slot * slot_size)
+                          for slot, shape in zip(message['slots'], message['shapes'])]
+                sock.sendall(self.image_ack(message.get('stream', 0)))
+                tracing.mark(message['timestamps'], 'received')
+                if 'rois' in message:
+                    rois = [RegionOfInterest(bbox, image) for bbox, image in zip(message['rois'], images)]
+                    frame = Frame(None, message['size'], message['seq'], rois, message['timestamps'],
+                                  message.get('stream', 0))
+                else:
+                    frame = Frame(images[0], message['size'], message['seq'], timestamps=message['timestamps'],
+                                  stream_id=message.get('stream', 0))
+                frames_received.inc()
                 self.queue.put(frame)
             else:
                 raise Exception(f'Not expecting message of {message["type"]}.')
@@ -37,28 +172,395 @@ class FrameTransmissionReceiver(transmission.TransmissionReceiver):
 
 
 class FrameTransmissionSender(transmission.TransmissionSender):
+    """
+    Sends key frames while the server has granted credits for their stream. Out of credits, the newest
+    frame of the stream is held back, replacing any older one, until a grant arrives with an image ack
+    or a detection reply. A server that grants no credits is not flow controlled.
+    """
+    def __init__(self, server_host, server_port, profile=None):
+        super().__init__(server_host, server_port)
+        if profile is None:
+            profile = frame_utils.EncodingProfile()
+        self.profile = profile
+        self.credit_limits = {}     # stream_id -> frames of the stream the server accepts in total
+        self.sent_counts = {}       # stream_id -> frames of the stream sent
+        self.held_frames = {}       # stream_id -> newest frame waiting for a credit
+        self.clock_samples = deque(maxlen=CLOCK_SAMPLES)   # (round trip, server clock ahead of the local one)
+        self.sent_stages = {}       # (stream_id, frame_seq) -> stages marked locally before the frame was sent
+
+    # Seconds the server clock is ahead of the local one, from the fastest recent metadata round trip: its
+    #   server time was taken closest to the midpoint. None until a server that reports its time acked.
+    def clock_offset(self):
+        if not self.clock_samples:
+            return None
+        return min(self.clock_samples)[1]
+
+    def has_credit(self, stream_id):
+        # the first frame of a stream is always sent, its ack carries the first grant
+        return self.sent_counts.get(stream_id, 0) < self.credit_limits.get(stream_id, 1)
+
+    # Forgets the grants, for a new connection to a server that starts counting from zero.
+    def reset_credits(self):
+        self.credit_limits.clear()
+        self.sent_counts.clear()
+        self.sent_stages.clear()
+
+    # @return{bool} whether the frame was sent now, otherwise it is held until a credit arrives.
     def send(self, frame):
-        print(f'Sending frame {frame.frame_seq}...')
-        frame_bytes = frame_utils.image_to_bytes(frame.image)
-        metadata_message = {
-            'type': METADATA_MESSAGE,
-            'size': frame.size,
-            'bytes_size': len(frame_bytes),
-            'seq': frame.frame_seq
-        }
+        stream_id = frame.stream_id
+        if not self.has_credit(stream_id):
+            if stream_id in self.held_frames:
+                frames_replaced.inc()
+            self.held_frames[stream_id] = frame
+            frames_held.set(len(self.held_frames))
+            logger.debug('Holding frame %d of stream %d, out of credits.', frame.frame_seq, stream_id)
+            return False
+        image_ack = self.transmit(frame)
+        self.sent_counts[stream_id] = self.sent_counts.get(stream_id, 0) + 1
+        self.grant(stream_id, image_ack.get('credit_limit', float('inf')))
+        return True
+
+    # Raises the credit limit of the stream and sends its held frame if that freed a credit.
+    def grant(self, stream_id, credit_limit):
+        if credit_limit is None:
+            return
+        self.credit_limits[stream_id] = max(self.credit_limits.get(stream_id, 0), credit_limit)
+        if stream_id in self.held_frames and self.sent_counts.get(stream_id, 0) < self.credit_limits[stream_id]:
+            frame = self.held_frames.pop(stream_id)
+            frames_held.set(len(self.held_frames))
+            self.send(frame)
+
+    def on_reply(self, detected_objects):
+        stream_id = detected_objects.stream_id
+        local_stages = self.sent_stages.pop((stream_id, detected_objects.frame_seq), None)
+        # frames of the stream sent before were superseded on the server and get no reply
+        for key in [key for key in self.sent_stages if key[0] == stream_id and key[1] < detected_objects.frame_seq]:
+            del self.sent_stages[key]
+        offset = self.clock_offset()
+        if local_stages is not None and offset is not None:
+            # the stages the server marked lie between those sent and reply_received
+            tracing.to_local_clock(detected_objects.timestamps, local_stages, len(detected_objects.timestamps) - 1,
+                                   offset)
+        self.grant(stream_id, detected_objects.credit_limit)
+
+    # Sends the frame regardless of credits. @return{dict} the image ack of the server.
+    def transmit(self, frame):
+        logger.debug('Sending frame %d...', frame.frame_seq)
+        encode_start = time.perf_counter()
+        if frame.rois:
+            rois_bytes = [self.profile.encode(roi.image) for roi in frame.rois]
+            metadata_message = {
+                'type': ROI_METADATA_MESSAGE,
+                'size': frame.size,
+                'rois': [roi.bbox for roi in frame.rois],
+                'bytes_sizes': [len(roi_bytes) for roi_bytes in rois_bytes],
+                'seq': frame.frame_seq,
+                'stream': frame.stream_id
+            }
+            frame_bytes = b''.join(rois_bytes)
+        else:
+            frame_bytes = self.profile.encode(frame.image)
+            metadata_message = {
+                'type': METADATA_MESSAGE,
+                'size': frame.size,
+                'bytes_size': len(frame_bytes),
+                'seq': frame.frame_seq,
+                'stream': frame.stream_id
+            }
+        encode_time = time.perf_counter() - encode_start
+        # a copy per attempt, a frame resent to another server of a pool is not marked twice
+        metadata_message['timestamps'] = list(frame.timestamps)
+        tracing.mark(metadata_message['timestamps'], 'encoded')
+        metadata_start = time.perf_counter()
+        metadata_sent = time.time()
         self.sender_socket.sendall(json.dumps(metadata_message).encode())
-        print('Sending frame metadata...')
+        logger.debug('Sending frame metadata...')
         metadata_ack = json.loads(self.sender_socket.recv(transmission.BUFFER_SIZE))
         if metadata_ack is None or \
                 'type' not in metadata_ack or \
                 metadata_ack['type'] != METADATA_ACK_MESSAGE:
             raise Exception(f'Invalid message {metadata_ack}.')
-        print('Metadata ack received.')
-        print('Sending the image...')
+        # the small metadata message takes a round trip, the image ack the transfer and a round trip
+        round_trip = time.perf_counter() - metadata_start
+        if 'time' in metadata_ack:
+            self.clock_samples.append((round_trip, metadata_ack['time'] - (metadata_sent + time.time()) / 2))
+        self.sent_stages[(frame.stream_id, frame.frame_seq)] = len(metadata_message['timestamps'])
+        logger.debug('Metadata ack received.')
+        logger.debug('Sending the image...')
+        send_start = time.perf_counter()
         self.sender_socket.sendall(frame_bytes)
         image_ack = json.loads(self.sender_socket.recv(transmission.BUFFER_SIZE))
         if image_ack is None or \
                 'type' not in image_ack or \
                 image_ack['type'] != IMAGE_ACK_MESSAGE:
             raise Exception(f'Invalid message {image_ack}.')
-        print('Image ack received.')
+        send_time = time.perf_counter() - send_start
+        self.profile.update(len(frame_bytes), send_time, round_trip)
+        jpeg_quality.set(self.profile.quality)
+        jpeg_scale.set(self.profile.scale)
+        if self.profile.throughput is not None:
+            link_throughput.set(self.profile.throughput)
+        frames_sent.inc()
+        bytes_sent.inc(len(frame_bytes))
+        frame_bytes_histogram.observe(len(frame_bytes))
+        encode_seconds.observe(encode_time)
+        send_seconds.observe(send_time)
+        logger.debug('Image ack received.')
+        logger.debug('Frame %d: %d bytes, encoded in %.1f ms (quality %d, scale %.2f).', frame.frame_seq,
+                     len(frame_bytes), encode_time * 1000, self.profile.quality, self.profile.scale)
+        return image_ack
+
+
+class SharedMemorySegment:
+    """A shared memory segment of equal slots, each holding one image until the server is done with it."""
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self.free_slots = list(range(slots))
+
+    def in_use(self):
+        return len(self.free_slots) < self.slots
+
+    def write(self, slot, image):
+        view = np.ndarray(image.shape, dtype=np.uint8, buffer=self.memory.buf, offset=slot * self.slot_size)
+        np.copyto(view, image)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SharedMemoryFrameSender(FrameTransmissionSender):
+    """
+    Frame sender for a server on the same host. Raw frames are copied into slots of shared memory segments
+    and only the slot indices and metadata go over the socket. The server reads the slots in place, so a
+    frame keeps its slots until the reply for it, or for a later frame of its stream, which means the server
+    dropped it. When no segment has enough free slots large enough for a frame, a new one of `slots` slots
+    sized for the largest frame so far is added, and segments outgrown by larger frames are unlinked once
+    free. slot_size is the smallest slot size, by default that of the first frame.
+    """
+    def __init__(self, server_host, server_port, slots=SHM_SLOTS, slot_size=None):
+        super().__init__(server_host, server_port)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.segments = []
+        self.frame_slots = {}   # (stream_id, frame_seq) -> (segment, slots) the server may still read
+        self.retired = []       # names of unlinked segments the server has not been told about
+
+    # @return{tuple} a segment and free slots of it for the images, which are taken until released.
+    def allocate(self, images):
+        size = max(image.nbytes for image in images)
+        for segment in self.segments:
+            if segment.slot_size >= size and len(segment.free_slots) >= len(images):
+                break
+        else:
+            slot_size = max([size, self.slot_size or 0] + [segment.slot_size for segment in self.segments])
+            segment = SharedMemorySegment(max(self.slots, len(images)), slot_size)
+            self.segments.append(segment)
+            logger.info('Added a shared memory segment of %d slots of %d bytes.', segment.slots, slot_size)
+        return segment, [segment.free_slots.pop(0) for _ in images]
+
+    # Frees the slots of the frames of the stream up to frame_seq.
+    def release(self, stream_id, frame_seq):
+        for key in [key for key in self.frame_slots if key[0] == stream_id and key[1] <= frame_seq]:
+            segment, slots = self.frame_slots.pop(key)
+            segment.free_slots.extend(slots)
+        if not self.segments:
+            return
+        largest = max(segment.slot_size for segment in self.segments)
+        for segment in [segment for segment in self.segments if segment.slot_size < largest and not segment.in_use()]:
+            self.segments.remove(segment)
+            self.retired.append(segment.memory.name)
+            segment.close()
+
+    def on_reply(self, detected_objects):
+        self.release(detected_objects.stream_id, detected_objects.frame_seq)
+        super().on_reply(detected_objects)
+
+    def transmit(self, frame):
+        logger.debug('Sending frame %d...', frame.frame_seq)
+        images = [roi.image for roi in frame.rois] if frame.rois else [frame.image]
+        segment, slots = self.allocate(images)
+        for slot, image in zip(slots, images):
+            segment.write(slot, image)
+        key = (frame.stream_id, frame.frame_seq)
+        self.frame_slots[key] = (segment, slots)
+        message = {
+            'type': SHM_FRAME_MESSAGE,
+            'size': frame.size,
+            'seq': frame.frame_seq,
+            'stream': frame.stream_id,
+            'shm': segment.memory.name,
+            'slot_size': segment.slot_size,
+            'slots': slots,
+            'shapes': [list(image.shape) for image in images],
+            'retired': self.retired,
+        }
+        if frame.rois:
+            message['rois'] = [roi.bbox for roi in frame.rois]
+        message['timestamps'] = list(frame.timestamps)
+        tracing.mark(message['timestamps'], 'written')
+        try:
+            self.sender_socket.sendall(json.dumps(message).encode())
+            image_ack = json.loads(self.sender_socket.recv(transmission.BUFFER_SIZE))
+        except Exception:
+            # the server never saw the frame
+            segment.free_slots.extend(self.frame_slots.pop(key)[1])
+            raise
+        if image_ack is None or \
+                'type' not in image_ack or \
+                image_ack['type'] != IMAGE_ACK_MESSAGE:
+            raise Exception(f'Invalid message {image_ack}.')
+        self.retired = []
+        frames_sent.inc()
+        logger.debug('Image ack received.')
+        return image_ack
+
+    def close(self):
+        super().close()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        self.frame_slots.clear()
+        self.retired = []
+
+
+class PooledServer:
+    def __init__(self, sender):
+        self.sender = sender
+        self.alive = False
+        self.in_flight = {}         # (stream_id, frame_seq) -> send time
+        self.response_time = None   # smoothed seconds from send to reply
+        self.backoff = REVIVE_BACKOFF
+        self.revive_time = 0
+        self.reviving = False       # a background thread is reconnecting the server
+
+    def name(self):
+        return f'{self.sender.server_host}:{self.sender.server_port}'
+
+    # Expected wait for a new frame, servers without a measured response time are tried first.
+    def load(self):
+        return (len(self.in_flight) + 1) * (self.response_time or 0)
+
+
+class FrameSenderPool:
+    """
+    Spreads key frames over several detection servers, all replying to the same client. Each frame goes to
+    the live server with credits for its stream and the lowest expected wait, its in-flight frames times its
+    smoothed response time. A server that fails to send, or does not answer within response_timeout or
+    RESPONSE_TIMEOUT_FACTOR times its response time if that is longer, is marked dead and reconnected in the
+    background after a backoff doubling up to MAX_REVIVE_BACKOFF. With no server available the newest frame of
+    a stream is held, as a single sender does.
+    """
+    def __init__(self, senders, response_timeout=RESPONSE_TIMEOUT):
+        self.servers = [PooledServer(sender) for sender in senders]
+        self.response_timeout = response_timeout
+        self.held_frames = {}
+
+    # @return{bool} whether any server is connected, the others are retried in the background of send.
+    def connect(self):
+        for server in self.servers:
+            if not server.alive:
+                self.reconnect(server)
+        servers_alive.set(sum(server.alive for server in self.servers))
+        return any(server.alive for server in self.servers)
+
+    # Reconnects a dead server on a background thread: the connect to a host that has gone away would stall
+    #   the client loop for as long as the OS retries it.
+    def revive(self, server):
+        server.reviving = True
+        threading.Thread(target=self.reconnect, args=(server,), name=f'revive {server.name()}', daemon=True).start()
+
+    def reconnect(self, server):
+        try:
+            if server.sender.connect(CONNECT_TIMEOUT):
+                server.sender.sender_socket.settimeout(self.response_timeout)
+                server.sender.reset_credits()
+                server.backoff = REVIVE_BACKOFF
+                # last, the client loop sends to the server from here on
+                server.alive = True
+                logger.info('Connected to server %s.', server.name())
+            else:
+                server.revive_time = time.time() + server.backoff
+                server.backoff = min(server.backoff * 2, MAX_REVIVE_BACKOFF)
+        finally:
+            server.reviving = False
+
+    def mark_dead(self, server, reason):
+        logger.warning('Server %s is dead: %s', server.name(), reason)
+        server_failures.inc()
+        server.alive = False
+        server.in_flight.clear()
+        # the response time is kept, a slow server is not given a shorter timeout once revived
+        try:
+            server.sender.close()
+        except Exception:
+            pass
+        server.revive_time = time.time() + server.backoff
+        server.backoff = min(server.backoff * 2, MAX_REVIVE_BACKOFF)
+
+    # Seconds the oldest frame in flight to the server may wait for its reply.
+    def timeout(self, server):
+        return max(self.response_timeout, RESPONSE_TIMEOUT_FACTOR * (server.response_time or 0))
+
+    def check_servers(self):
+        now = time.time()
+        for server in self.servers:
+            if server.alive:
+                if server.in_flight and now - min(server.in_flight.values()) > self.timeout(server):
+                    self.mark_dead(server, 'no reply')
+            elif not server.reviving and now >= server.revive_time:
+                self.revive(server)
+        servers_alive.set(sum(server.alive for server in self.servers))
+
+    def send(self, frame):
+        self.check_servers()
+        stream_id = frame.stream_id
+        while True:
+            candidates = [server for server in self.servers
+                          if server.alive and server.sender.has_credit(stream_id)]
+            if not candidates:
+                if stream_id in self.held_frames:
+                    frames_replaced.inc()
+                self.held_frames[stream_id] = frame
+                frames_held.set(len(self.held_frames))
+                return False
+            server = min(candidates, key=PooledServer.load)
+            try:
+                server.sender.send(frame)
+            except Exception as ex:
+                self.mark_dead(server, ex)
+                servers_alive.set(sum(server.alive for server in self.servers))
+                continue
+            server.in_flight[(stream_id, frame.frame_seq)] = time.time()
+            logger.debug('Frame %d of stream %d sent to %s.', frame.frame_seq, stream_id, server.name())
+            return True
+
+    def on_reply(self, detected_objects):
+        stream_id = detected_objects.stream_id
+        for server in self.servers:
+            sent_time = server.in_flight.pop((stream_id, detected_objects.frame_seq), None)
+            if sent_time is None:
+                continue
+            response_time = time.time() - sent_time
+            if server.response_time is None:
+                server.response_time = response_time
+            else:
+                server.response_time += RESPONSE_TIME_SMOOTHING * (response_time - server.response_time)
+            # older frames of the stream were superseded on the server and get no reply
+            for stream_id_, frame_seq in list(server.in_flight):
+                if stream_id_ == stream_id and frame_seq < detected_objects.frame_seq:
+                    del server.in_flight[(stream_id_, frame_seq)]
+            server.sender.on_reply(detected_objects)
+            break
+        frame = self.held_frames.pop(stream_id, None)
+        frames_held.set(len(self.held_frames))
+        if frame is not None:
+            self.send(frame)
+
+    def close(self):
+        for server in self.servers:
+            if server.alive:
+                server.sender.close()
+
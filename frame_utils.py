@@ -1,16 +1,32 @@
+import copy
+import functools
 import io
 import cv2
-from PIL import Image
 from abc import ABC, abstractmethod
 import numpy as np
 import os
 import time
 import utils.bb_util as bb_util
 import random
+import logging
+import threading
 
+from metrics import REGISTRY
+
+
+logger = logging.getLogger(__name__)
+
+frames_decoded = REGISTRY.counter('frames_decoded', 'Video frames decoded at full resolution')
 
 COLOR_NUM = 100
-RANDOM_COLORS = [(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)) for _ in range(COLOR_NUM)]
+RANDOM_COLORS = []  # filled on the first draw_bbox
+
+
+DETECTOR_INPUT_SIZE = (800, 1333)   # min and max side the detector resizes its input to
+QUALITY_STEP = 5
+SCALE_STEP = 0.8
+THROUGHPUT_SMOOTHING = 0.2
+THUMBNAIL_MODE = cv2.IMREAD_REDUCED_GRAYSCALE_4   # decode of the frame read up front, the full one is lazy
 
 
 def image_to_bytes(image):
@@ -20,6 +36,84 @@ def image_to_bytes(image):
     return None
 
 
+class EncodingProfile:
+    """
+    JPEG encoding settings for key frames. Frames are downscaled to at most the detector's input size
+    since the detector would resize them anyway. With adaptive set, quality and then scale are lowered
+    while a frame takes longer than target_send_time to transfer at the measured link throughput, which
+    leaves out the round trip of the link, and raised back when there is room.
+    """
+    def __init__(self, quality=95, scale=1.0, fast=False, adaptive=False, max_input_size=DETECTOR_INPUT_SIZE,
+                 target_send_time=0.05, min_quality=40, min_scale=0.25):
+        self.quality = quality
+        self.scale = scale
+        self.fast = fast
+        self.adaptive = adaptive
+        self.max_input_size = max_input_size
+        self.target_send_time = target_send_time
+        self.min_quality = min_quality
+        self.max_quality = quality
+        self.min_scale = min_scale
+        self.max_scale = scale
+        self.resize_buffer = None
+        self.throughput = None  # bytes per second, without the round trip
+
+    # A profile with the same settings and state, adapted from here on to the link of another sender.
+    def copy(self):
+        profile = copy.copy(self)
+        profile.resize_buffer = None
+        return profile
+
+    def frame_scale(self, image):
+        scale = self.scale
+        if self.max_input_size is not None:
+            min_size, max_size = self.max_input_size
+            scale = min(scale, min_size / min(image.shape[:2]), max_size / max(image.shape[:2]))
+        return scale
+
+    # @return{ndarray} the encoded bytes as a uint8 array, which can be sent without copying.
+    def encode(self, image):
+        scale = self.frame_scale(image)
+        if scale < 1:
+            width = max(1, int(round(image.shape[1] * scale)))
+            height = max(1, int(round(image.shape[0] * scale)))
+            shape = (height, width) + image.shape[2:]
+            if self.resize_buffer is None or self.resize_buffer.shape != shape:
+                self.resize_buffer = np.empty(shape, dtype=image.dtype)
+            interpolation = cv2.INTER_LINEAR if self.fast else cv2.INTER_AREA
+            image = cv2.resize(image, (width, height), dst=self.resize_buffer, interpolation=interpolation)
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(self.quality), cv2.IMWRITE_JPEG_OPTIMIZE, 0 if self.fast else 1]
+        is_success, im_buf_arr = cv2.imencode(".jpg", image, params)
+        if not is_success:
+            raise Exception('Could not encode the frame.')
+        return im_buf_arr.reshape(-1)
+
+    # Records a frame of bytes_size bytes that took send_time seconds from sending to its ack, round_trip of
+    #   which is the latency of the link rather than the transfer, and adapts the settings.
+    def update(self, bytes_size, send_time, round_trip=0.0):
+        transfer_time = send_time - round_trip
+        # a frame sent within the round trip says nothing about the bandwidth
+        if transfer_time > 0:
+            rate = bytes_size / transfer_time
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput += THROUGHPUT_SMOOTHING * (rate - self.throughput)
+        if not self.adaptive or self.throughput is None:
+            return
+        budget = self.throughput * self.target_send_time
+        if bytes_size > budget:
+            if self.quality > self.min_quality:
+                self.quality = max(self.min_quality, self.quality - QUALITY_STEP)
+            else:
+                self.scale = max(self.min_scale, self.scale * SCALE_STEP)
+        elif bytes_size < budget / 2:
+            if self.scale < self.max_scale:
+                self.scale = min(self.max_scale, self.scale / SCALE_STEP)
+            else:
+                self.quality = min(self.max_quality, self.quality + QUALITY_STEP)
+
+
 def bytes_to_image(image_bytes):
     nparr = np.frombuffer(image_bytes, dtype="uint8")
     return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
@@ -32,6 +126,7 @@ def pil_to_cv2(image):
 
 
 def cv2_to_pil(open_cv_image):
+    from PIL import Image
     return Image.fromarray(open_cv_image)
 
 
@@ -49,9 +144,11 @@ def socket_recv_all(sock, size):
 
 
 def diff_img(img1, img2):
-    # Grey and resize
-    img1 = cv2.cvtColor(img1, cv2.COLOR_RGB2GRAY)
-    img2 = cv2.cvtColor(img2, cv2.COLOR_RGB2GRAY)
+    # Grey and resize, thumbnails decoded as grayscale are already grey
+    if img1.ndim == 3:
+        img1 = cv2.cvtColor(img1, cv2.COLOR_RGB2GRAY)
+    if img2.ndim == 3:
+        img2 = cv2.cvtColor(img2, cv2.COLOR_RGB2GRAY)
     img1 = cv2.resize(img1, (320, 200), interpolation=cv2.INTER_AREA)
     img2 = cv2.resize(img2, (320, 200), interpolation=cv2.INTER_AREA)
     # Calculate
@@ -60,6 +157,9 @@ def diff_img(img1, img2):
 
 # BBoxes are [x1 y1 x2 y2]
 def draw_bbox(image, bbox, color_id=0, padding=1):
+    if not RANDOM_COLORS:
+        RANDOM_COLORS.extend((random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+                             for _ in range(COLOR_NUM))
     color = RANDOM_COLORS[color_id % COLOR_NUM]
     image_height = image.shape[0]
     image_width = image.shape[1]
@@ -73,11 +173,99 @@ def draw_bbox(image, bbox, color_id=0, padding=1):
     return image
 
 
-class Frame:
-    def __init__(self, image, size, frame_seq):
+class RegionOfInterest:
+    def __init__(self, bbox, image):
+        self.bbox = bbox    # [x1 y1 x2 y2] of the crop in frame coordinates
         self.image = image
-        self.size = size
+
+
+class Frame:
+    """
+    A video frame. A reader may leave image None and give a loader instead, the full resolution pixels are then
+    only decoded the first time image is read, and a reduced gray thumbnail for the cheap per-frame checks.
+    """
+    def __init__(self, image, size, frame_seq, rois=None, timestamps=None, stream_id=0, thumbnail=None, loader=None):
+        self._image = image
+        self._size = size
+        self.loader = loader        # returns the full image, called once on first access
+        self.load_lock = threading.Lock() if loader is not None else None
+        self.thumbnail = thumbnail  # reduced grayscale version of the frame, None when the reader made none
         self.frame_seq = frame_seq
+        self.stream_id = stream_id  # video of the frame when a client multiplexes several over one connection
+        self.rois = rois    # when set, only these regions of the frame are transmitted
+        if timestamps is None:
+            timestamps = [['capture', time.time()]]
+        self.timestamps = timestamps    # [stage, time] pairs appended as the frame moves through the pipeline
+
+    @property
+    def image(self):
+        if self._image is None and self.loader is not None:
+            # a key frame may be read by a detection worker and the tracking thread at once
+            with self.load_lock:
+                if self._image is None and self.loader is not None:
+                    self._image = self.loader()
+                    self.loader = None
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+
+    @property
+    def size(self):
+        if self._size is None and self.image is not None:
+            self._size = list(self.image.shape)
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        self._size = size
+
+    # The thumbnail if there is one, else the full image, for comparisons that do not need every pixel.
+    def preview(self):
+        return self.thumbnail if self.thumbnail is not None else self.image
+
+
+# Padded crops around the given boxes, clipped to the image.
+# @bboxes{ndarray 4xN} xyxy boxes to crop around.
+# @padding{number} scale of the crop relative to its box.
+def crop_rois(image, bboxes, padding):
+    image_height = image.shape[0]
+    image_width = image.shape[1]
+    crops = bb_util.scale_bbox_batch(np.asarray(bboxes, dtype=np.float32), padding)
+    crops = bb_util.clip_bbox(crops, 0, image_width, image_height)
+    rois = []
+    for x1, y1, x2, y2 in np.round(crops).astype(int).T:
+        if x2 - x1 < 1 or y2 - y1 < 1:
+            continue
+        rois.append(RegionOfInterest([int(x1), int(y1), int(x2), int(y2)], image[y1:y2, x1:x2]))
+    return rois
+
+
+class KeyFrameSelector:
+    """
+    Decides which frames are sent for detection: the first frame, then any frame that differs enough from the
+    last key frame once min_distance seconds of video have passed since it.
+    """
+    def __init__(self, frame_rate, diff_threshold, min_distance):
+        self.frame_rate = frame_rate
+        self.diff_threshold = diff_threshold
+        self.min_distance = min_distance
+        self.last_key_frame = None
+        self.frame_cnt = 0
+
+    def is_key_frame(self, frame):
+        if self.last_key_frame is None:
+            self.last_key_frame = frame
+            return True
+        self.frame_cnt += 1
+        diff = diff_img(self.last_key_frame.preview(), frame.preview())
+        logger.debug('diff between #%d and #%d is %d', self.last_key_frame.frame_seq, frame.frame_seq, diff)
+        if diff > self.diff_threshold and self.frame_cnt * (1 / self.frame_rate) > self.min_distance:
+            self.frame_cnt = 0
+            self.last_key_frame = frame
+            return True
+        return False
 
 
 class VideoReader(ABC):
@@ -94,9 +282,20 @@ class VideoReader(ABC):
         raise NotImplementedError()
 
 
+def read_image(path):
+    frames_decoded.inc()
+    return cv2.imread(path)
+
+
 class DirectoryVideoReader(VideoReader):
-    def __init__(self, directory_path, start_seq=0):
+    """
+    Reads the image files of a directory in name order. With thumbnail_mode, a cv2.IMREAD_REDUCED_* flag, each
+    frame is only decoded at that reduced scale when read and its full image is decoded lazily, so frames that
+    are never tracked, sent or drawn never pay for it. None decodes every frame in full up front.
+    """
+    def __init__(self, directory_path, start_seq=0, thumbnail_mode=THUMBNAIL_MODE):
         self.start_seq = start_seq
+        self.thumbnail_mode = thumbnail_mode
         self.current_frame_seq = self.start_seq
         self.directory_path = directory_path
         self.frames_path = [os.path.join(self.directory_path, f) for f in os.listdir(self.directory_path)]
@@ -108,7 +307,8 @@ class DirectoryVideoReader(VideoReader):
                 continue
             image = None
             try:
-                image = cv2.imread(path)
+                # the smallest decode is enough to know the file is a readable image
+                image = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
             except:
                 to_delete.append(path)
                 continue
@@ -123,8 +323,11 @@ class DirectoryVideoReader(VideoReader):
 
     def get_frame(self, frame_seq):
         frame_path = self.frames_path[frame_seq]
-        image = cv2.imread(frame_path)
-        return Frame(image, list(image.shape), frame_seq)
+        if self.thumbnail_mode is None:
+            image = read_image(frame_path)
+            return Frame(image, list(image.shape), frame_seq)
+        thumbnail = cv2.imread(frame_path, self.thumbnail_mode)
+        return Frame(None, None, frame_seq, thumbnail=thumbnail, loader=functools.partial(read_image, frame_path))
 
     def next_frame(self):
         frame = self.get_frame(self.current_frame_seq)
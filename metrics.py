@@ -0,0 +1,241 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)   # seconds
+BYTES_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def to_dict(self):
+        return self.value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def to_dict(self):
+        return self.value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _HistogramTimer(self)
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', cumulative))
+        samples.append((f'{self.name}_sum', self.sum))
+        samples.append((f'{self.name}_count', self.count))
+        return samples
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip([str(bound) for bound in self.buckets + ('+Inf',)], self.counts)),
+        }
+
+
+class _HistogramTimer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            metric = self.metrics[name]
+        if not isinstance(metric, cls):
+            raise Exception(f'Metric {name} is already registered as a {metric.kind}.')
+        return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def render_text(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {value}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        return {name: metric.to_dict() for name, metric in list(self.metrics.items())}
+
+
+# Process wide registry the client and server modules record into.
+REGISTRY = MetricsRegistry()
+
+# Set to 1 once the process has loaded and warmed up its models, also served on /ready.
+ready = REGISTRY.gauge('ready', 'Whether the models are loaded and warmed up')
+startup_seconds = REGISTRY.gauge('startup_seconds', 'Seconds from start until ready')
+
+
+class MetricsServer:
+    """
+    Serves the registry in the Prometheus text format on http://host:port/metrics, and on /ready a 200 once
+    the ready gauge is set, 503 before.
+    """
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/ready':
+                    is_ready = registry_.gauge('ready').value == 1
+                    body = b'ready\n' if is_ready else b'starting\n'
+                    self.send_response(200 if is_ready else 503)
+                    self.send_header('Content-Type', 'text/plain')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry_.render_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info(f'Serving metrics on port {self.http_server.server_address[1]}.')
+
+    def close(self):
+        self.http_server.shutdown()
+
+
+class MetricsDumper:
+    """Periodically writes the registry as a JSON line to a file."""
+    def __init__(self, path, interval=10.0, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.dump_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def dump(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'metrics': self.registry.to_dict()}) + '\n')
+
+    def dump_loop(self):
+        while not self.stop.wait(self.interval):
+            self.dump()
+
+    def close(self):
+        self.stop.set()
+        self.dump()
+
+
+def start_exporters(port=None, dump_path=None, interval=10.0):
+    """Starts the exporters requested on the command line."""
+    exporters = []
+    if port is not None:
+        exporters.append(MetricsServer(port))
+    if dump_path is not None:
+        exporters.append(MetricsDumper(dump_path, interval))
+    for exporter in exporters:
+        exporter.start()
+    return exporters
+
+
+def add_arguments(parser):
+    """Adds the logging and metrics options shared by the client and the server."""
+    parser.add_argument('-log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Log level, DEBUG logs every frame')
+    parser.add_argument('-metrics_port', type=int, default=None,
+                        help='Serve metrics on http://127.0.0.1:port/metrics and readiness on /ready')
+    parser.add_argument('-metrics_dump', type=str, default=None, help='File metrics are appended to as JSON lines')
+    parser.add_argument('-metrics_interval', type=float, default=10.0, help='Seconds between metrics dumps')
+
+
+def configure(args):
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    return start_exporters(args.metrics_port, args.metrics_dump, args.metrics_interval)
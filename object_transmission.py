@@ -1,6 +1,15 @@
 import json
+import logging
 import transmission
 import numpy as np
+import tracing
+from metrics import REGISTRY
+
+
+logger = logging.getLogger(__name__)
+
+replies_sent = REGISTRY.counter('replies_sent', 'Detection replies sent by the server')
+replies_received = REGISTRY.counter('replies_received', 'Detection replies received by the client')
 
 
 class DetectedObject:
@@ -27,23 +36,35 @@ class DetectedObject:
 
 
 class DetectedObjects:
-    def __init__(self, frame_seq, objects=None):
+    def __init__(self, frame_seq, objects=None, timestamps=None, stream_id=0, credit_limit=None, failed=False):
         self.frame_seq = frame_seq
+        self.stream_id = stream_id
+        self.credit_limit = credit_limit    # flow control grant of the server for the stream
+        self.failed = failed                # the detector failed on the frame, the reply only carries the grant
         if objects is None:
             objects = []
         self.objects = objects
+        if timestamps is None:
+            timestamps = []
+        self.timestamps = timestamps    # stage timestamps of the detected frame
 
     def to_json(self):
         return json.dumps({
             'seq': self.frame_seq,
+            'stream': self.stream_id,
             'objects': [obj.to_json() for obj in self.objects],
+            'timestamps': self.timestamps,
+            'credit_limit': self.credit_limit,
+            'failed': self.failed,
         })
 
     @staticmethod
     def from_json(json_str):
         objects_dic = json.loads(json_str)
         objects = [DetectedObject.from_dict(obj) for obj in objects_dic['objects']]
-        detected_objects = DetectedObjects(objects_dic['seq'], objects)
+        detected_objects = DetectedObjects(objects_dic['seq'], objects, objects_dic.get('timestamps'),
+                                           objects_dic.get('stream', 0), objects_dic.get('credit_limit'),
+                                           objects_dic.get('failed', False))
         return detected_objects
 
 
@@ -51,6 +72,8 @@ class ObjectTransmissionReceiver(transmission.TransmissionReceiver):
     def handle_data(self, sock, data):
         txt = data.decode()
         detected_objects = DetectedObjects.from_json(txt)
+        tracing.mark(detected_objects.timestamps, 'reply_received')
+        replies_received.inc()
         self.queue.put(detected_objects)
         sock.sendall('ack'.encode())
 
@@ -58,11 +81,13 @@ class ObjectTransmissionReceiver(transmission.TransmissionReceiver):
 class ObjectTransmissionSender(transmission.TransmissionSender):
     def send(self, detected_objects):
         detected_objects.objects.sort(key=lambda obj: obj.confidence, reverse=True)
-        print(f'Sending object {detected_objects.frame_seq}...')
+        logger.debug('Sending object %d...', detected_objects.frame_seq)
+        tracing.mark(detected_objects.timestamps, 'reply_sent')
         object_message = detected_objects.to_json().encode()
         self.sender_socket.sendall(object_message)
         ack = self.sender_socket.recv(transmission.BUFFER_SIZE).decode()
         if ack and ack == 'ack':
-            print('Object ack received.')
+            replies_sent.inc()
+            logger.debug('Object ack received.')
         else:
             raise Exception(f'Invalid message {ack}.')
@@ -0,0 +1,177 @@
+"""
+Offline runner for archived footage: key frame selection, detection and tracking run in-process, without
+sockets and without pacing the video to its frame rate, and every track is logged to a CSV file per video.
+Several videos are processed in parallel, one process each, e.g.
+    python offline.py -videos videos/a videos/b videos/c -out logs -jobs 3
+"""
+import argparse
+import csv
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import frame_utils
+import metrics
+from client import MAX_OBJ_TRACK_NUM, FRAME_DIFF_THRESHOLD, MIN_KEY_FRAME_DISTANCE, ROI_PADDING, \
+    FULL_FRAME_REFRESH_INTERVAL
+from tracker.association import TrackAssociator
+
+
+DETECTION_LAG = 3           # frames between a key frame and applying its detections, as if from the server
+DETECTION_WORKERS = 2
+TRACK_LOG_HEADER = ['frame_seq', 'track_id', 'label', 'x1', 'y1', 'x2', 'y2']
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineProcessor:
+    """
+    Runs a VideoReader through the client pipeline as fast as it can be computed. Key frames go to a pool of
+    detection workers and their results are applied detection_lag frames later, waiting for them if needed,
+    so the output does not depend on how long the detector takes.
+    detector is a callable from a Frame to DetectedObjects, the Faster R-CNN of the server by default.
+    """
+    def __init__(self, video_reader, log_path, frame_rate, detector=None, model_path='checkpoint.pth',
+                 max_tracks=MAX_OBJ_TRACK_NUM, frame_diff_threshold=FRAME_DIFF_THRESHOLD,
+                 min_key_frame_distance=MIN_KEY_FRAME_DISTANCE, detection_lag=DETECTION_LAG,
+                 detection_workers=DETECTION_WORKERS):
+        if detector is None:
+            import server
+            detector = functools.partial(server.detect_objects, server.load_model())
+        self.video_reader = video_reader
+        self.log_path = log_path
+        self.detector = detector
+        self.detection_lag = detection_lag
+        self.detection_workers = detection_workers
+        self.key_frame_selector = frame_utils.KeyFrameSelector(frame_rate, frame_diff_threshold,
+                                                               min_key_frame_distance)
+        from tracker.re3_tracker import Re3Tracker
+        self.tracker = Re3Tracker(model_path)
+        self.associator = TrackAssociator(max_tracks)
+
+    # @return{int} number of frames processed.
+    def run(self):
+        frame_cnt = 0
+        key_frame_cnt = 0
+        pending = deque()   # (frame_seq to apply at, detection future, key frame, track boxes at the key frame)
+        frame_cache = []    # frames after the oldest pending key frame, replayed for re-initialized tracks
+        with ThreadPoolExecutor(self.detection_workers) as pool, open(self.log_path, 'w', newline='') as log_file:
+            writer = csv.writer(log_file)
+            writer.writerow(TRACK_LOG_HEADER)
+            while self.video_reader.has_next():
+                frame = self.video_reader.next_frame()
+                frame_cnt += 1
+                is_key_frame = self.key_frame_selector.is_key_frame(frame)
+                if pending and pending[0][0] <= frame.frame_seq:
+                    _, future, key_frame, key_boxes = pending.popleft()
+                    try:
+                        objects = future.result()
+                    except Exception as ex:
+                        # e.g. a corrupt frame, the tracks go on until the next key frame as in the client
+                        logger.exception('Detection of key frame #%d failed: %s', key_frame.frame_seq, ex)
+                    else:
+                        self.apply_detections(objects, key_frame, key_boxes, frame_cache)
+                    frame_cache = [cached for cached in frame_cache
+                                   if pending and cached.frame_seq > pending[0][2].frame_seq]
+                tracks = self.associator.tracks
+                if tracks:
+                    bboxes = self.tracker.track_batch([track.id for track in tracks], frame.image)
+                    for i, track in enumerate(tracks):
+                        track.bbox = bboxes[:, i]
+                        writer.writerow([frame.frame_seq, track.id, track.label] +
+                                        [round(float(item), 2) for item in track.bbox])
+                # the key frame is detected once tracked, so its crops and track boxes are those of the frame itself
+                if is_key_frame:
+                    key_frame_cnt += 1
+                    if tracks and key_frame_cnt % FULL_FRAME_REFRESH_INTERVAL != 0:
+                        track_boxes = np.stack([track.bbox for track in tracks], axis=1)
+                        frame.rois = frame_utils.crop_rois(frame.image, track_boxes, ROI_PADDING)
+                    pending.append((frame.frame_seq + self.detection_lag, pool.submit(self.detector, frame), frame,
+                                    self.associator.snapshot()))
+                if pending:
+                    frame_cache.append(frame)
+            for _, future, _, _ in pending:
+                future.cancel()
+        return frame_cnt
+
+    def apply_detections(self, objects, key_frame, key_boxes, frame_cache):
+        result = self.associator.update(objects.objects, key_boxes)
+        for track in result.retired:
+            self.tracker.remove(track.id)
+        # only drifted and new tracks are re-initialized and replayed up to the current frame
+        reinit_tracks = result.reseeded + result.spawned
+        if not reinit_tracks:
+            return
+        for track in reinit_tracks:
+            self.tracker.track(track.id, key_frame.image, bbox=track.bbox)
+        replay_ids = [track.id for track in reinit_tracks]
+        for cached_frame in frame_cache:
+            if cached_frame.frame_seq <= key_frame.frame_seq:
+                continue
+            bboxes = self.tracker.track_batch(replay_ids, cached_frame.image)
+            for i, track in enumerate(reinit_tracks):
+                track.bbox = bboxes[:, i]
+
+
+def process_video(video_path, out_dir, options):
+    log_path = os.path.join(out_dir, os.path.basename(os.path.normpath(video_path)) + '.csv')
+    start = time.time()
+    processor = OfflineProcessor(frame_utils.DirectoryVideoReader(video_path), log_path, **options)
+    frame_cnt = processor.run()
+    seconds = time.time() - start
+    logger.info('%s: %d frames in %.1fs (%.1f FPS) -> %s', video_path, frame_cnt, seconds,
+                frame_cnt / max(seconds, 1e-9), log_path)
+    return video_path, frame_cnt, seconds
+
+
+def init_worker(threads):
+    # each process gets its share of the cores instead of torch defaulting to all of them
+    import torch
+    torch.set_num_threads(threads)
+
+
+def process_videos(video_paths, out_dir, jobs, options):
+    """Processes each video directory in its own process, jobs at a time. Returns (path, frames, seconds) each."""
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = max(1, min(jobs, len(video_paths)))
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    if jobs == 1:
+        init_worker(threads)
+        return [process_video(video_path, out_dir, options) for video_path in video_paths]
+    with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(threads,)) as pool:
+        return pool.starmap(process_video, [(video_path, out_dir, options) for video_path in video_paths])
+
+
+# offline program arguments
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Offline batch processing.')
+    parser.add_argument('-videos', type=str, nargs='+', required=True, help='Video directories')
+    parser.add_argument('-out', type=str, required=True, help='Directory of the track logs')
+    parser.add_argument('-frame_rate', type=int, default=30, help='Video FPS, for the key frame distance')
+    parser.add_argument('-jobs', type=int, default=1, help='Videos processed in parallel')
+    parser.add_argument('-detection_lag', type=int, default=DETECTION_LAG,
+                        help='Frames between a key frame and applying its detections')
+    parser.add_argument('-detection_workers', type=int, default=DETECTION_WORKERS,
+                        help='Detection threads per video')
+    parser.add_argument('-max_tracks', type=int, default=MAX_OBJ_TRACK_NUM, help='Maximum tracks per video')
+    parser.add_argument('-model', type=str, default='checkpoint.pth', help='Re3 checkpoint path')
+    metrics.add_arguments(parser)
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    metrics.configure(args)
+    process_videos(args.videos, args.out, args.jobs, {
+        'frame_rate': args.frame_rate,
+        'model_path': args.model,
+        'max_tracks': args.max_tracks,
+        'detection_lag': args.detection_lag,
+        'detection_workers': args.detection_workers,
+    })
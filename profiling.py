@@ -0,0 +1,144 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+
+PROFILE_SECONDS = 10.0
+
+logger = logging.getLogger(__name__)
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Opt-in profiling of the client and server loops. A capture is requested for a number of seconds, from the
+    command line or with SIGUSR1, and while it lasts every loop that calls tick() runs under cProfile, span()
+    records stage timers and the loops that run models are traced by torch.profiler. When the capture ends the
+    results are written to out_dir as <thread>-<time>.pstats, torch-<thread>-<time>.json and spans-<time>.json
+    (the latter two in the Chrome trace format). Outside of a capture tick() and span() only check an attribute.
+    """
+    def __init__(self, out_dir='profiles', seconds=PROFILE_SECONDS):
+        self.out_dir = out_dir
+        self.seconds = seconds
+        self.capture_until = None
+        self.capture_seconds = None
+        self.stamp = None
+        self.lock = threading.Lock()
+        self.thread_profiles = {}
+        self.torch_profiles = {}
+        self.events = []
+
+    def request_capture(self, seconds=None):
+        if seconds is None:
+            seconds = self.seconds
+        self.stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.capture_seconds = seconds
+        # the window starts once the first loop has set up its profilers
+        self.capture_until = float('inf')
+
+    # Called by a loop on every iteration, starts and stops the capture in the calling thread. The profiles are
+    #   named after the thread.
+    def tick(self, torch_ops=False):
+        if self.capture_until is None:
+            return
+        name = threading.current_thread().name
+        if time.time() < self.capture_until:
+            if name not in self.thread_profiles:
+                self._start(name, torch_ops)
+        elif name in self.thread_profiles:
+            self._stop(name)
+
+    def span(self, name):
+        if self.capture_until is None:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def _start(self, name, torch_ops):
+        os.makedirs(self.out_dir, exist_ok=True)
+        if torch_ops:
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            torch_profile = torch.profiler.profile(activities=activities, record_shapes=True)
+            torch_profile.__enter__()
+            self.torch_profiles[name] = torch_profile
+        profile = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles[name] = profile
+        logger.info(f'Profiling {name}...')
+        if self.capture_until == float('inf'):
+            self.capture_until = time.time() + self.capture_seconds
+        profile.enable()
+
+    def _stop(self, name):
+        with self.lock:
+            profile = self.thread_profiles.pop(name)
+            done = not self.thread_profiles
+        profile.disable()
+        profile.dump_stats(os.path.join(self.out_dir, f'{name}-{self.stamp}.pstats'))
+        torch_profile = self.torch_profiles.pop(name, None)
+        if torch_profile is not None:
+            torch_profile.__exit__(None, None, None)
+            torch_profile.export_chrome_trace(os.path.join(self.out_dir, f'torch-{name}-{self.stamp}.json'))
+        if done:
+            self.capture_until = None
+            with self.lock:
+                events, self.events = self.events, []
+            with open(os.path.join(self.out_dir, f'spans-{self.stamp}.json'), 'w') as f:
+                json.dump({'traceEvents': events}, f)
+            logger.info(f'Profiles written to {self.out_dir}.')
+
+
+class _Span:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+        self.record = None
+
+    def __enter__(self):
+        if threading.current_thread().name in self.profiler.torch_profiles:
+            import torch
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        if self.record is not None:
+            self.record.__exit__(exc_type, exc_val, exc_tb)
+        event = {
+            'name': self.name,
+            'ph': 'X',
+            'ts': self.start * 1e6,
+            'dur': (end - self.start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().name,
+        }
+        with self.profiler.lock:
+            self.profiler.events.append(event)
+
+
+def add_arguments(parser):
+    parser.add_argument('-profile', type=float, default=None,
+                        help='Profile the first n seconds, SIGUSR1 starts a capture at any time')
+    parser.add_argument('-profile_dir', type=str, default='profiles', help='Directory the profiles are written to')
+    parser.add_argument('-profile_seconds', type=float, default=PROFILE_SECONDS,
+                        help='Length of a capture started with SIGUSR1')
+
+
+def configure(args):
+    profiler = Profiler(args.profile_dir, args.profile_seconds)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.request_capture())
+    if args.profile is not None:
+        profiler.request_capture(args.profile)
+    return profiler
@@ -0,0 +1,177 @@
+"""
+CPU resources of the client and server processes. By default torch runs as many intra-op threads as there are
+cores in every thread that calls a model, OpenCV keeps its own pool of the same size, and on a many-core host
+the detector, the tracker and the frame codec threads oversubscribe each other. A ResourceConfig caps these
+pools and optionally pins each stage to its own set of cores:
+    detector    the server threads that load and run Faster R-CNN
+    tracker     the client threads that load and run Re3, they also decode the frames they track and
+                encode the key frames
+    codec       the threads that decode frames, the video readers of the client and the frame receiver of the
+                server
+The same options can be given to the client and the server on one host, each applies the stages it runs, e.g.
+    -torch_threads detector=6 tracker=2 -cv2_threads 1 -pin detector=2-7 tracker=0 codec=1
+or as a JSON file with -cpu_config, in the format written by benchmarks/cpu_benchmark.py -save_config.
+"""
+import json
+import logging
+import os
+import threading
+
+
+STAGES = ['detector', 'tracker', 'codec']
+TORCH_STAGES = ['detector', 'tracker']
+
+logger = logging.getLogger(__name__)
+
+
+# Core ids of a list like '0-3,6'.
+# @return{list} sorted core ids.
+def parse_cores(cores):
+    if isinstance(cores, (list, tuple)):
+        return sorted(int(core) for core in cores)
+    ids = set()
+    for part in str(cores).split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            ids.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            ids.add(int(part))
+    return sorted(ids)
+
+
+# The '0-3,6' form of a list of core ids.
+def format_cores(cores):
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(first) if first == last else f'{first}-{last}' for first, last in ranges)
+
+
+# Core ids this process may run on.
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# stage -> value of 'stage=value' items, value converted by parse.
+def parse_stage_items(items, parse):
+    values = {}
+    for item in items or []:
+        if '=' not in item:
+            raise Exception(f'Expected stage=value, got {item}.')
+        stage, value = item.split('=', 1)
+        if stage not in STAGES:
+            raise Exception(f'Unknown stage {stage}, expected one of {", ".join(STAGES)}.')
+        values[stage] = parse(value)
+    return values
+
+
+class ResourceConfig:
+    """
+    Thread pool sizes and core sets of the pipeline stages. apply() sets what is process-wide once at start,
+    enter(stage) is called by each thread of a stage before it runs anything heavy: OpenMP keeps the torch
+    thread count per calling thread, and the threads torch and OpenCV start later inherit its cores.
+    Settings left None keep the library defaults.
+    """
+    def __init__(self, torch_threads=None, interop_threads=None, cv2_threads=None, cores=None):
+        self.torch_threads = torch_threads or {}    # stage -> torch intra-op threads
+        self.interop_threads = interop_threads      # torch inter-op threads, can only be set once per process
+        self.cv2_threads = cv2_threads              # OpenCV threads, 0 runs its functions sequentially
+        self.cores = cores or {}                    # stage -> core ids the stage threads are pinned to
+        self.interop_lock = threading.Lock()
+        self.interop_set = False
+
+    @staticmethod
+    def from_dict(config):
+        stages = config.get('stages', {})
+        return ResourceConfig(
+            {stage: int(item['threads']) for stage, item in stages.items() if item.get('threads') is not None},
+            config.get('interop_threads'), config.get('cv2_threads'),
+            {stage: parse_cores(item['cores']) for stage, item in stages.items() if item.get('cores') is not None})
+
+    def to_dict(self):
+        stages = {}
+        for stage, threads in self.torch_threads.items():
+            stages.setdefault(stage, {})['threads'] = threads
+        for stage, cores in self.cores.items():
+            stages.setdefault(stage, {})['cores'] = format_cores(cores)
+        return {'interop_threads': self.interop_threads, 'cv2_threads': self.cv2_threads, 'stages': stages}
+
+    def describe(self):
+        parts = [f'{stage} threads={threads}' for stage, threads in sorted(self.torch_threads.items())]
+        parts += [f'{stage} cores={format_cores(cores)}' for stage, cores in sorted(self.cores.items())]
+        if self.interop_threads is not None:
+            parts.append(f'interop threads={self.interop_threads}')
+        if self.cv2_threads is not None:
+            parts.append(f'cv2 threads={self.cv2_threads}')
+        return ', '.join(parts) if parts else 'defaults'
+
+    def apply(self):
+        if self.cv2_threads is not None:
+            import cv2
+            cv2.setNumThreads(self.cv2_threads)
+        for stage, cores in self.cores.items():
+            unavailable = set(cores) - set(available_cores())
+            if unavailable:
+                raise Exception(f'Cores {format_cores(unavailable)} of stage {stage} are not available.')
+        logger.info('CPU resources: %s.', self.describe())
+
+    # Pins a thread, the calling one by default, to the cores of the stage.
+    def pin(self, stage, thread=None):
+        cores = self.cores.get(stage)
+        if not cores:
+            return
+        if not hasattr(os, 'sched_setaffinity'):
+            logger.warning('Pinning threads is not supported on this platform.')
+            return
+        # on Linux the affinity of a thread id only applies to that thread, 0 is the calling one
+        os.sched_setaffinity(0 if thread is None else thread.native_id, cores)
+
+    def enter(self, stage):
+        self.pin(stage)
+        if stage not in TORCH_STAGES:
+            return
+        threads = self.torch_threads.get(stage)
+        if threads is None and self.interop_threads is None:
+            return
+        # only the stages that run a model import torch, and they import it anyway
+        import torch
+        with self.interop_lock:
+            if self.interop_threads is not None and not self.interop_set:
+                self.interop_set = True
+                try:
+                    torch.set_num_interop_threads(self.interop_threads)
+                except RuntimeError as ex:
+                    logger.warning('Inter-op threads not set: %s', ex)
+        if threads is not None:
+            torch.set_num_threads(threads)
+
+
+def add_arguments(parser):
+    parser.add_argument('-torch_threads', type=str, nargs='+', default=None, metavar='STAGE=N',
+                        help='Torch intra-op threads of the detector and tracker stages')
+    parser.add_argument('-interop_threads', type=int, default=None, help='Torch inter-op threads')
+    parser.add_argument('-cv2_threads', type=int, default=None, help='OpenCV threads, 0 to disable its pool')
+    parser.add_argument('-pin', type=str, nargs='+', default=None, metavar='STAGE=CORES',
+                        help='Cores like 0-3,6 each of the detector, tracker and codec stages runs on')
+    parser.add_argument('-cpu_config', type=str, default=None,
+                        help='JSON file of these settings, the options above override it')
+
+
+def configure(args):
+    config = ResourceConfig()
+    if args.cpu_config is not None:
+        with open(args.cpu_config) as config_file:
+            config = ResourceConfig.from_dict(json.load(config_file))
+    config.torch_threads.update(parse_stage_items(args.torch_threads, int))
+    config.cores.update(parse_stage_items(args.pin, parse_cores))
+    if args.interop_threads is not None:
+        config.interop_threads = args.interop_threads
+    if args.cv2_threads is not None:
+        config.cv2_threads = args.cv2_threads
+    config.apply()
+    return config
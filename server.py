@@ -1,90 +1,288 @@
 import argparse
-from frame_transmission import FrameTransmissionReceiver
+import copy
+import logging
+import math
+import os
+from frame_transmission import FrameTransmissionReceiver, CreditLedger, SERVER_CREDITS
 from object_transmission import ObjectTransmissionSender, DetectedObjects, DetectedObject
 from queue import Queue
 import threading
 import time
-import torchvision
-import torchvision.transforms as T
+import cv2
+import numpy as np
 import frame_utils
 from frame_utils import Frame
+import tracing
+import metrics
+from metrics import REGISTRY
+import profiling
+import resources
+from resources import ResourceConfig
+from detection_cache import DetectionCache, CACHE_SIZE, CACHE_TTL, CACHE_TOLERANCE
 
 
 import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
 
 
+ROI_NMS_IOU = 0.5
+ROI_TILE_GAP = 32                                   # blank pixels between the rois tiled into one detector input
+DETECTOR_WEIGHTS = 'fasterrcnn_resnet50_fpn.pth'    # local copy of the pretrained weights
+WARMUP_RUNS = 2
+
+logger = logging.getLogger(__name__)
+
+frames_superseded = REGISTRY.counter('frames_superseded', 'Received frames dropped for a newer one')
+frames_detected = REGISTRY.counter('frames_detected', 'Frames run through the detector')
+detection_failures = REGISTRY.counter('detection_failures', 'Frames the detector failed on')
+frame_queue_depth = REGISTRY.gauge('frame_queue_depth', 'Frames waiting for the detector')
+detector_seconds = REGISTRY.histogram('detector_seconds', 'Detector time per frame')
+
+
+def load_model(weights_path=DETECTOR_WEIGHTS):
+    """Faster R-CNN with the weights at weights_path, downloaded and saved there if missing."""
+    # torch and torchvision take seconds to import, they are only loaded on the paths that run the model
+    import torch
+    import torchvision
+    if weights_path is not None and os.path.exists(weights_path):
+        model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained=False, pretrained_backbone=False)
+        model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    else:
+        model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained=True)
+        if weights_path is not None:
+            torch.save(model.state_dict(), weights_path)
+            logger.info('Saved the detector weights to %s.', weights_path)
+    # set to evaluation mode
+    model.eval()
+    return model
+
+
+def warmup(model, image_size=frame_utils.DETECTOR_INPUT_SIZE, runs=WARMUP_RUNS):
+    """Runs the detector on blank images, so the first frame does not pay for the allocator and kernel setup."""
+    import torch
+    image = torch.zeros((3,) + tuple(image_size))
+    with torch.no_grad():
+        for _ in range(runs):
+            model([image])
+
+
+# Scale the detector resizes a full frame of this size by.
+def detector_scale(frame_size, input_size=frame_utils.DETECTOR_INPUT_SIZE):
+    height, width = frame_size[:2]
+    return min(input_size[0] / min(height, width), input_size[1] / max(height, width))
+
+
+# Tiles the rois of a frame into one image, each resized to the scale its region has in the full frame detector
+#   input, so the detector sees the objects at the size it would in the full frame and costs the rois' share of it.
+# @return{tuple} (image, tiles) tiles is an Nx4 ndarray of the xyxy box of each roi in the image.
+def tile_rois(frame):
+    scale = detector_scale(frame.size)
+    images = []
+    for roi in frame.rois:
+        x1, y1, x2, y2 = roi.bbox
+        size = (max(1, int(round((x2 - x1) * scale))), max(1, int(round((y2 - y1) * scale))))
+        images.append(cv2.resize(roi.image, size, interpolation=cv2.INTER_LINEAR))
+    # shelves of the tallest crops first, about as wide as the tiled image is high
+    shelf_width = max(max(image.shape[1] for image in images),
+                      int(math.sqrt(sum(image.shape[0] * image.shape[1] for image in images))))
+    tiles = np.zeros((len(images), 4), dtype=np.float32)
+    x = y = shelf_height = 0
+    for i in sorted(range(len(images)), key=lambda i: -images[i].shape[0]):
+        height, width = images[i].shape[:2]
+        if x > 0 and x + width > shelf_width:
+            x, y, shelf_height = 0, y + shelf_height + ROI_TILE_GAP, 0
+        tiles[i] = [x, y, x + width, y + height]
+        x += width + ROI_TILE_GAP
+        shelf_height = max(shelf_height, height)
+    tiled = np.zeros((int(tiles[:, 3].max()), int(tiles[:, 2].max()), 3), dtype=np.uint8)
+    for image, (x1, y1, x2, y2) in zip(images, tiles.astype(int)):
+        tiled[y1:y2, x1:x2] = image
+    return tiled, tiles
+
+
+# Maps the boxes detected on tiled rois back to frame coordinates. Each box belongs to the tile of its center
+#   and is clipped to it, boxes centered between the tiles are dropped.
+# @boxes{ndarray Mx4} xyxy boxes in the tiled image.
+# @return{tuple} (keep, boxes) indices of the kept boxes and their xyxy boxes in the frame.
+def untile_boxes(boxes, tiles, regions):
+    centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    inside = ((centers_x[:, None] >= tiles[:, 0]) & (centers_x[:, None] < tiles[:, 2]) &
+              (centers_y[:, None] >= tiles[:, 1]) & (centers_y[:, None] < tiles[:, 3]))
+    keep = np.flatnonzero(inside.any(axis=1))
+    tile_index = inside[keep].argmax(axis=1)
+    tile = tiles[tile_index]
+    region = np.asarray(regions, dtype=np.float32)[tile_index]
+    scale = (region[:, 2:] - region[:, :2]) / (tile[:, 2:] - tile[:, :2])
+    boxes = np.clip(boxes[keep], tile[:, [0, 1, 0, 1]], tile[:, [2, 3, 2, 3]])
+    return keep, (boxes - tile[:, [0, 1, 0, 1]]) * scale[:, [0, 1, 0, 1]] + region[:, [0, 1, 0, 1]]
+
+
+def detect_native_scale(model, image):
+    """Runs the detector on one image tensor without resizing it, the stages of GeneralizedRCNN.forward."""
+    # a copy of the transform with the image's own sizes, the model may be shared by several threads
+    transform = copy.copy(model.transform)
+    transform.min_size = (min(image.shape[-2:]),)
+    transform.max_size = max(image.shape[-2:])
+    images, _ = transform([image])
+    features = model.backbone(images.tensors)
+    proposals, _ = model.rpn(images, features)
+    detections, _ = model.roi_heads(features, proposals, images.image_sizes)
+    return transform.postprocess(detections, images.image_sizes, [tuple(image.shape[-2:])])[0]
+
+
+def detect_objects(model, frame: Frame):
+    """Runs the detector over the rois of the frame, or the whole frame, and returns the boxes in frame coordinates."""
+    # grad mode is per thread, the server loop and each offline detection worker call this without autograd
+    import torch
+    import torchvision
+    import torchvision.transforms as T
+    transform = T.Compose([T.ToTensor()])
+    if frame.rois:
+        image, tiles = tile_rois(frame)
+        img = transform(frame_utils.cv2_to_pil(image))
+        tracing.mark(frame.timestamps, 'preprocessed')
+        with torch.no_grad():
+            pred = detect_native_scale(model, img)
+        tracing.mark(frame.timestamps, 'inferred')
+        keep, boxes = untile_boxes(pred['boxes'].detach().numpy(), tiles, [roi.bbox for roi in frame.rois])
+        keep = torch.from_numpy(keep)
+        labels, boxes, scores = pred['labels'][keep], torch.from_numpy(boxes), pred['scores'].detach()[keep]
+        if len(frame.rois) > 1:
+            # padded regions can overlap and detect the same object twice
+            keep = torchvision.ops.batched_nms(boxes, scores, labels, ROI_NMS_IOU)
+            labels, boxes, scores = labels[keep], boxes[keep], scores[keep]
+    else:
+        img = transform(frame_utils.cv2_to_pil(frame.image))
+        tracing.mark(frame.timestamps, 'preprocessed')
+        with torch.no_grad():
+            pred = model([img])[0]
+        tracing.mark(frame.timestamps, 'inferred')
+        # the client may have downscaled the image
+        scale_x = frame.size[1] / frame.image.shape[1]
+        scale_y = frame.size[0] / frame.image.shape[0]
+        labels, scores = pred['labels'], pred['scores'].detach()
+        boxes = pred['boxes'].detach() * torch.tensor([scale_x, scale_y, scale_x, scale_y])
+    objects = []
+    for label, bbox, score in list(zip(labels.numpy(), boxes.numpy(), scores.numpy())):
+        bbox = [float(item) for item in bbox]
+        detected_object = DetectedObject(int(label), bbox, float(score))
+        objects.append(detected_object)
+    return DetectedObjects(frame.frame_seq, objects, frame.timestamps, frame.stream_id)
+
+
 class ObjectDetectionServer:
-    def __init__(self, host, port, client_host, client_port):
+    def __init__(self, host, port, client_host, client_port, profiler=None, detection_cache=None,
+                 credits=SERVER_CREDITS, weights_path=DETECTOR_WEIGHTS, warmup_runs=WARMUP_RUNS, resources=None):
         self.host = host
         self.port = port
         self.client_host = client_host
         self.client_port = client_port
         self.frame_queue = Queue()
-        self.frame_receiver = FrameTransmissionReceiver(self.host, self.port, self.frame_queue)
+        self.credit_ledger = CreditLedger(credits)
+        self.frame_receiver = FrameTransmissionReceiver(self.host, self.port, self.frame_queue, self.credit_ledger)
         self.object_sender = ObjectTransmissionSender(self.client_host, self.client_port)
+        self.weights_path = weights_path
+        self.warmup_runs = warmup_runs
         self.model = None
         self.connection_thread = None
         self.server_thread = None
+        if profiler is None:
+            profiler = profiling.Profiler()
+        self.profiler = profiler
+        if detection_cache is None:
+            detection_cache = DetectionCache()
+        self.detection_cache = detection_cache
+        if resources is None:
+            resources = ResourceConfig()
+        self.resources = resources
 
     def start(self):
-        self.frame_receiver.start()
-        print('Waiting for client...')
+        # the model loads while waiting for the client, frames are only accepted once it is ready
+        prepare_thread = threading.Thread(target=self.prepare, args=(time.time(),), name='prepare')
+        prepare_thread.start()
+        logger.info('Waiting for client...')
         while True:
             if self.object_sender.connect():
-                print('Connected to client.')
+                logger.info('Connected to client.')
                 break
             time.sleep(2)
-        self.model = self.load_model()
-        self.server_thread = threading.Thread(target=self.server_loop)
+        prepare_thread.join()
+        if self.frame_receiver.receiver_thread is None:
+            raise Exception('Detector failed to load.')
+        self.server_thread = threading.Thread(target=self.server_loop, name='server_loop')
         self.server_thread.start()
         self.server_thread.join()
 
+    def prepare(self, start_time):
+        self.resources.enter('detector')
+        self.model = self.load_model()
+        self.warmup()
+        self.frame_receiver.start()
+        # the receiver decodes the key frames
+        self.resources.pin('codec', self.frame_receiver.receiver_thread)
+        metrics.startup_seconds.set(time.time() - start_time)
+        metrics.ready.set(1)
+        logger.info('Ready in %.1fs.', time.time() - start_time)
+
     def load_model(self):
-        # load model
-        model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained=True)
-        # set to evaluation mode
-        model.eval()
-        return model
+        return load_model(self.weights_path)
+
+    def warmup(self):
+        warmup(self.model, runs=self.warmup_runs)
 
     def detect_object(self, frame: Frame):
-        transform = T.Compose([T.ToTensor()])
-        img = frame_utils.cv2_to_pil(frame.image)
-        img = transform(img)
-        preds = self.model([img])
-        objects = []
-        for label, bbox, score in list(zip(
-                preds[0]['labels'].numpy(),
-                preds[0]['boxes'].detach().numpy(),
-                preds[0]['scores'].detach().numpy())):
-            bbox = [float(item) for item in bbox]
-            detected_object = DetectedObject(int(label), bbox, float(score))
-            objects.append(detected_object)
-        return DetectedObjects(frame.frame_seq, objects)
+        return detect_objects(self.model, frame)
+
+    def run_detector(self, frame: Frame):
+        with detector_seconds.time():
+            objects = self.detect_object(frame)
+        frames_detected.inc()
+        return objects
 
     def server_loop(self):
-        print('Server loop started')
+        logger.info('Server loop started')
+        self.resources.enter('detector')
         while True:
             try:
-                max_seq = -1
-                max_frame = None
+                self.profiler.tick(torch_ops=True)
+                # only the newest frame of each stream is detected
+                latest_frames = {}
+                frame_queue_depth.set(self.frame_queue.qsize())
                 while not self.frame_queue.empty():
                     frame = self.frame_queue.get()
-                    if frame.frame_seq > max_seq:
-                        max_frame = frame
-                        max_seq = frame.frame_seq
-                frame = max_frame
-                if frame is None:
+                    latest = latest_frames.get(frame.stream_id)
+                    if latest is not None:
+                        frames_superseded.inc()
+                        # the dropped frame gives its credit back
+                        self.credit_ledger.complete(frame.stream_id)
+                    if latest is None or frame.frame_seq > latest.frame_seq:
+                        latest_frames[frame.stream_id] = frame
+                if not latest_frames:
                     time.sleep(0.1)
                     continue
-                print(f'Frame #{frame.frame_seq} received.')
-                objects = self.detect_object(frame)
-                print(f'{len(objects.objects)} objects detected.')
-                self.object_sender.send(objects)
+                for frame in latest_frames.values():
+                    tracing.mark(frame.timestamps, 'dequeued')
+                    logger.debug('Frame #%d of stream %d received.', frame.frame_seq, frame.stream_id)
+                    try:
+                        with self.profiler.span('detect'):
+                            objects = self.detection_cache.detect(frame, self.run_detector)
+                    except Exception as ex:
+                        # e.g. a corrupt image, the client still gets its credit back with an empty reply
+                        logger.exception('Detection of frame #%d of stream %d failed: %s', frame.frame_seq,
+                                         frame.stream_id, ex)
+                        detection_failures.inc()
+                        objects = DetectedObjects(frame.frame_seq, [], frame.timestamps, frame.stream_id, failed=True)
+                    finally:
+                        self.credit_ledger.complete(frame.stream_id)
+                    objects.credit_limit = self.credit_ledger.credit_limit(frame.stream_id)
+                    logger.debug('%d objects detected.', len(objects.objects))
+                    with self.profiler.span('send_reply'):
+                        self.object_sender.send(objects)
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception as ex:
-                print(ex)
+                logger.exception(ex)
 
 
 # server program arguments
@@ -94,6 +292,19 @@ def build_arg_parser():
     parser.add_argument('-port', type=int, required=True, help='Server port')
     parser.add_argument('-client_host', type=str, required=True, help='Client host')
     parser.add_argument('-client_port', type=int, required=True, help='Client port')
+    parser.add_argument('-weights', type=str, default=DETECTOR_WEIGHTS,
+                        help='Detector weights, downloaded to this path on the first run')
+    parser.add_argument('-warmup_runs', type=int, default=WARMUP_RUNS, help='Detector runs on a blank image at start')
+    parser.add_argument('-credits', type=int, default=SERVER_CREDITS,
+                        help='Key frames per stream in flight to the server before the client holds them back')
+    parser.add_argument('-cache_size', type=int, default=CACHE_SIZE,
+                        help='Detections kept per stream for reuse on near-duplicate key frames, 0 to disable')
+    parser.add_argument('-cache_ttl', type=float, default=CACHE_TTL, help='Seconds a detection may be reused')
+    parser.add_argument('-cache_tolerance', type=float, default=CACHE_TOLERANCE,
+                        help='Largest gray level difference of the frame thumbnails for which a detection is reused')
+    metrics.add_arguments(parser)
+    profiling.add_arguments(parser)
+    resources.add_arguments(parser)
     return parser
 
 
@@ -101,7 +312,13 @@ if __name__ == '__main__':
     try:
         arg_parser = build_arg_parser()
         args = arg_parser.parse_args()  # parse arguments
-        server = ObjectDetectionServer(args.host, args.port, args.client_host, args.client_port)
+        metrics.configure(args)
+        profiler = profiling.configure(args)
+        resource_config = resources.configure(args)
+        detection_cache = DetectionCache(args.cache_size, args.cache_ttl, args.cache_tolerance)
+        server = ObjectDetectionServer(args.host, args.port, args.client_host, args.client_port, profiler,
+                                       detection_cache, args.credits, args.weights, args.warmup_runs,
+                                       resource_config)
         server.start()
     except Exception as e:
-        print(e)
+        logger.exception(e)
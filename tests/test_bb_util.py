@@ -0,0 +1,69 @@
+"""The bb_util batch API against the per-box functions it replaces in the tracker."""
+import numpy as np
+import pytest
+
+import utils.bb_util as bb_util
+from benchmarks.bb_util_benchmark import random_boxes
+
+
+def per_box(func, num_boxes):
+    return np.stack([func(i) for i in range(num_boxes)], axis=1)
+
+
+def assert_close(actual, expected, name=''):
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-3, err_msg=name)
+
+
+@pytest.mark.parametrize('num_boxes', [1, 16])
+def test_batch_matches_per_box(num_boxes):
+    rng = np.random.default_rng(0)
+    boxes = random_boxes(num_boxes, rng)
+    crops = random_boxes(num_boxes, rng)
+    out = np.empty_like(boxes)
+    cases = {
+        'xyxy_to_xywh': (per_box(lambda i: bb_util.xyxy_to_xywh(boxes[:, i]), num_boxes),
+                         bb_util.xyxy_to_xywh_batch(boxes, out=out)),
+        'xywh_to_xyxy': (per_box(lambda i: bb_util.xywh_to_xyxy(boxes[:, i]), num_boxes),
+                         bb_util.xywh_to_xyxy_batch(boxes)),
+        'scale_bbox': (per_box(lambda i: bb_util.scale_bbox(boxes[:, i], 1.5), num_boxes),
+                       bb_util.scale_bbox_batch(boxes, 1.5)),
+        'to_crop_coordinate_system': (
+            per_box(lambda i: bb_util.to_crop_coordinate_system(boxes[:, i], crops[:, i], 2, 227), num_boxes),
+            bb_util.to_crop_coordinate_system_batch(boxes, crops, 2, 227)),
+        'from_crop_coordinate_system': (
+            per_box(lambda i: bb_util.from_crop_coordinate_system(boxes[:, i], crops[:, i], 2, 227), num_boxes),
+            bb_util.from_crop_coordinate_system_batch(boxes, crops, 2, 227)),
+    }
+    for name, (expected, actual) in cases.items():
+        assert_close(actual, expected, name)
+
+
+def test_from_crop_in_place_over_transpose():
+    rng = np.random.default_rng(1)
+    boxes = random_boxes(16, rng)
+    crops = random_boxes(16, rng)
+    expected = bb_util.from_crop_coordinate_system_batch(boxes, crops, 2, 227)
+    # the tracker converts its Nx4 predictions in place through their transpose
+    boxes_nx4 = np.ascontiguousarray(boxes.T)
+    bb_util.from_crop_coordinate_system_batch(boxes_nx4.T, crops, 2, 227, out=boxes_nx4.T)
+    assert_close(boxes_nx4.T, expected)
+
+
+def test_crop_round_trip_with_shared_work():
+    rng = np.random.default_rng(2)
+    boxes = random_boxes(16, rng)
+    crops = random_boxes(16, rng)
+    out = np.empty_like(boxes)
+    work = np.empty_like(boxes)
+    bb_util.to_crop_coordinate_system_batch(boxes, crops, 2, 227, out=out, work=work)
+    bb_util.from_crop_coordinate_system_batch(out, crops, 2, 227, out=out, work=work)
+    assert_close(out, boxes)
+
+
+def test_from_crop_of_empty_crop():
+    # a tracked box collapsed to zero width maps every crop coordinate onto its origin, without dividing by zero
+    bboxes = np.array([[0.0], [0.0], [227.0], [227.0]], dtype=np.float32)
+    crops = np.array([[10.0], [20.0], [10.0], [60.0]], dtype=np.float32)
+    with np.errstate(all='raise'):
+        actual = bb_util.from_crop_coordinate_system_batch(bboxes, crops, 2, 227)
+    assert_close(actual, bb_util.from_crop_coordinate_system(bboxes[:, 0], crops[:, 0], 2, 227)[:, None])
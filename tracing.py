@@ -0,0 +1,77 @@
+import json
+import time
+from collections import deque
+import numpy as np
+
+
+LATENCY_WINDOW = 1000   # most recent samples kept per stage
+PERCENTILES = (50, 95, 99)
+
+
+# Appends a [stage, wall clock time] pair to a frame's timestamps.
+def mark(timestamps, stage):
+    timestamps.append([stage, time.time()])
+
+
+# Moves the stages marked on another host, timestamps[start:end], to the local clock.
+# @offset{float} seconds the clock of the other host is ahead of the local one.
+def to_local_clock(timestamps, start, end, offset):
+    for entry in timestamps[start:end]:
+        entry[1] -= offset
+
+
+class LatencyHistogram:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self):
+        values = np.percentile(np.fromiter(self.samples, dtype=np.float64), PERCENTILES) * 1000
+        summary = {f'p{p}': float(value) for p, value in zip(PERCENTILES, values)}
+        summary['count'] = self.count
+        return summary
+
+
+class LatencyTracer:
+    """
+    Aggregates the stage timestamps that travel with a frame to the server and back into per-stage
+    latency histograms, and periodically exports their p50/p95/p99 in milliseconds as a JSON line,
+    to export_path if given or to stdout.
+    Stages marked by a server on another host are moved to the client clock by the frame sender, with the
+    offset estimated from its metadata round trips, so the stages crossing hosts are off by at most half of
+    that round trip. Servers that do not report their clock leave those stages on their own clock.
+    """
+    def __init__(self, export_interval=10.0, export_path=None):
+        self.export_interval = export_interval
+        self.export_path = export_path
+        self.histograms = {}
+        self.last_export = time.time()
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = LatencyHistogram()
+        return self.histograms[name]
+
+    def record(self, timestamps):
+        for (prev_stage, prev_time), (stage, stage_time) in zip(timestamps, timestamps[1:]):
+            self.histogram(f'{prev_stage}->{stage}').add(stage_time - prev_time)
+        if len(timestamps) > 1:
+            self.histogram('end_to_end').add(timestamps[-1][1] - timestamps[0][1])
+        if time.time() - self.last_export >= self.export_interval:
+            self.export()
+
+    def summary(self):
+        return {name: histogram.percentiles() for name, histogram in self.histograms.items()}
+
+    def export(self):
+        self.last_export = time.time()
+        line = json.dumps({'time': self.last_export, 'latency_ms': self.summary()})
+        if self.export_path is None:
+            print(line)
+        else:
+            with open(self.export_path, 'a') as f:
+                f.write(line + '\n')
@@ -0,0 +1,118 @@
+import itertools
+import numpy as np
+
+import utils.bb_util as bb_util
+
+
+MATCH_IOU = 0.3     # minimum iou for a detection to be matched to a track
+RESEED_IOU = 0.7    # matched tracks below this iou have drifted and are re-seeded
+MAX_MISSES = 2      # key frames a track may go unmatched before it is retired
+MIN_CONFIDENCE = 0.5
+
+
+class Track:
+    def __init__(self, id, bbox, label, confidence):
+        self.id = id
+        self.bbox = bbox
+        self.label = label
+        self.confidence = confidence
+        self.hits = 1
+        self.misses = 0
+
+
+class AssociationResult:
+    def __init__(self):
+        self.kept = []      # matched and still on target, tracker state is left alone
+        self.reseeded = []  # matched but drifted, tracker must be re-initialized with track.bbox
+        self.spawned = []   # new tracks, tracker must be initialized with track.bbox
+        self.retired = []   # tracks that were dropped
+
+
+def greedy_assignment(iou, min_iou):
+    """Matches pairs in order of decreasing iou. Returns (rows, cols)."""
+    rows, cols = [], []
+    if iou.size == 0:
+        return rows, cols
+    used_rows = np.zeros(iou.shape[0], dtype=bool)
+    used_cols = np.zeros(iou.shape[1], dtype=bool)
+    order = np.argsort(iou, axis=None)[::-1]
+    for row, col in zip(*np.unravel_index(order, iou.shape)):
+        if iou[row, col] < min_iou:
+            break
+        if used_rows[row] or used_cols[col]:
+            continue
+        used_rows[row] = used_cols[col] = True
+        rows.append(row)
+        cols.append(col)
+        if len(rows) == min(iou.shape):
+            break
+    return rows, cols
+
+
+class TrackAssociator:
+    """Keeps a set of tracks with stable ids and matches each new detection reply against them."""
+    def __init__(self, max_tracks, match_iou=MATCH_IOU, reseed_iou=RESEED_IOU, max_misses=MAX_MISSES,
+                 min_confidence=MIN_CONFIDENCE):
+        self.max_tracks = max_tracks
+        self.match_iou = match_iou
+        self.reseed_iou = reseed_iou
+        self.max_misses = max_misses
+        self.min_confidence = min_confidence
+        self.tracks = []
+        self.id_counter = itertools.count(1)
+
+    def snapshot(self):
+        """Track boxes by id, to be recorded alongside a key frame when it is sent."""
+        return {track.id: np.array(track.bbox, dtype=np.float32) for track in self.tracks}
+
+    def update(self, detections, track_boxes=None):
+        """
+        Associates detections (objects with bbox, label and confidence) with the live tracks.
+        track_boxes maps track id to its box on the detected key frame, tracks missing from it
+        are compared by their current box.
+        """
+        if track_boxes is None:
+            track_boxes = {}
+        result = AssociationResult()
+        detections = [det for det in detections if det.confidence >= self.min_confidence]
+        rows, cols = [], []
+        iou = np.zeros((len(self.tracks), len(detections)), dtype=np.float32)
+        if self.tracks and detections:
+            boxes_t = np.stack([track_boxes.get(track.id, track.bbox) for track in self.tracks], axis=1)
+            boxes_d = np.stack([det.bbox for det in detections], axis=1)
+            iou = bb_util.iou_matrix(boxes_t, boxes_d)
+            rows, cols = greedy_assignment(iou, self.match_iou)
+
+        matched_tracks = set(rows)
+        matched_detections = set(cols)
+        for row, col in zip(rows, cols):
+            track = self.tracks[row]
+            detection = detections[col]
+            track.hits += 1
+            track.misses = 0
+            track.label = detection.label
+            track.confidence = detection.confidence
+            if iou[row, col] < self.reseed_iou:
+                track.bbox = np.array(detection.bbox, dtype=np.float32)
+                result.reseeded.append(track)
+            else:
+                result.kept.append(track)
+
+        live_tracks = []
+        for row, track in enumerate(self.tracks):
+            if row not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    result.retired.append(track)
+                    continue
+            live_tracks.append(track)
+        self.tracks = live_tracks
+
+        unmatched = [det for col, det in enumerate(detections) if col not in matched_detections]
+        unmatched.sort(key=lambda det: det.confidence, reverse=True)
+        for detection in unmatched[:max(0, self.max_tracks - len(self.tracks))]:
+            track = Track(next(self.id_counter), np.array(detection.bbox, dtype=np.float32),
+                          detection.label, detection.confidence)
+            self.tracks.append(track)
+            result.spawned.append(track)
+        return result
@@ -10,6 +10,9 @@ CROP_PAD = 2
 
 MAX_TRACK_LENGTH = 4
 
+WARMUP_RUNS = 2
+WARMUP_ID = 'warmup'
+
 
 class Re3Tracker(object):
     def __init__(self, model_path='checkpoint.pth'):
@@ -52,8 +55,9 @@ class Re3Tracker(object):
 
         prev_image = image
 
-        predicted_bbox = bb_util.from_crop_coordinate_system(network_predicted_bbox.cpu().data.numpy() / 10,
-                                                             past_bbox_padded, 1, 1)
+        predicted_bbox = network_predicted_bbox.cpu().data.numpy() / 10
+        bb_util.from_crop_coordinate_system_batch(predicted_bbox.T, past_bbox_padded.reshape(4, 1), 1, 1,
+                                                  out=predicted_bbox.T)
 
         # Reset state
         if forward_count > 0 and forward_count % MAX_TRACK_LENGTH == 0:
@@ -70,5 +74,63 @@ class Re3Tracker(object):
 
         return predicted_bbox
 
+    # Tracks several ids already initialized with track() with a single forward pass.
+    # @image{ndarray or list} the image of all ids, or one image per id, e.g. to batch the tracks of several
+    # videos. Ids of the same image should be adjacent, each run of the same image is copied once.
+    # @return{ndarray 4xN} predicted bboxes, one column per id.
+    def track_batch(self, ids, image):
+        if isinstance(image, np.ndarray):
+            images = [image.copy()] * len(ids)
+        else:
+            images = []
+            for i, id_image in enumerate(image):
+                images.append(images[-1] if i > 0 and id_image is image[i - 1] else id_image.copy())
+        tracked = [self.tracked_data[id] for id in ids]
+        network_input = []
+        past_bboxes_padded = np.empty((4, len(ids)), dtype=np.float32)
+        for i, (_, _, past_bbox, prev_image, _) in enumerate(tracked):
+            cropped_input0, past_bboxes_padded[:, i] = im_util.get_cropped_input(prev_image, past_bbox, CROP_PAD,
+                                                                                 CROP_SIZE)
+            cropped_input1, _ = im_util.get_cropped_input(images[i], past_bbox, CROP_PAD, CROP_SIZE)
+            network_input.append(cropped_input0.transpose(2, 0, 1))
+            network_input.append(cropped_input1.transpose(2, 0, 1))
+        network_input = torch.tensor(np.stack(network_input), dtype=torch.float)
+        # per-id states are (1, 1, 512) tensors, batched along the second dimension
+        lstm_state = tuple(
+            tuple(torch.cat([data[0][layer][part] for data in tracked], 1) for part in range(2))
+            for layer in range(2))
+
+        with torch.no_grad():
+            network_input = network_input.to(self.device)
+            network_predicted_bbox, lstm_state = self.net(network_input, batch_size=len(ids),
+                                                          prevLstmState=lstm_state)
+
+        predicted_bboxes = np.ascontiguousarray(network_predicted_bbox.cpu().data.numpy().T / 10)
+        bb_util.from_crop_coordinate_system_batch(predicted_bboxes, past_bboxes_padded, 1, 1, out=predicted_bboxes)
+
+        for i, (id, (_, initial_state, _, _, forward_count)) in enumerate(zip(ids, tracked)):
+            state = tuple(tuple(lstm_state[layer][part][:, i:i + 1] for part in range(2)) for layer in range(2))
+            # Reset state
+            if forward_count > 0 and forward_count % MAX_TRACK_LENGTH == 0:
+                state = initial_state
+            self.tracked_data[id] = (state, initial_state, predicted_bboxes[:, i].copy(), images[i],
+                                     forward_count + 1)
+
+        return predicted_bboxes
+
+    # Runs the network on a blank image, so the first real track does not pay for the allocator warmup.
+    def warmup(self, runs=None):
+        if runs is None:
+            runs = WARMUP_RUNS
+        image = np.zeros((CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+        bbox = np.array([CROP_SIZE / 4, CROP_SIZE / 4, CROP_SIZE * 3 / 4, CROP_SIZE * 3 / 4], dtype=np.float32)
+        for _ in range(runs):
+            self.track(WARMUP_ID, image, bbox=bbox)
+            self.track_batch([WARMUP_ID], image)
+        self.remove(WARMUP_ID)
+
+    def remove(self, id):
+        self.tracked_data.pop(id, None)
+
     def reset(self):
         self.tracked_data = {}
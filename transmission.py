@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import logging
 import select
 import socket
 from queue import Queue
@@ -7,6 +8,8 @@ import threading
 
 BUFFER_SIZE = 4096
 
+logger = logging.getLogger(__name__)
+
 
 class TransmissionReceiver(ABC):
     def __init__(self, host, port, queue: Queue):
@@ -39,11 +42,16 @@ class TransmissionReceiver(ABC):
                     else:
                         try:
                             data = sock.recv(BUFFER_SIZE)
+                            if not data:
+                                # the peer closed the connection
+                                self.connected_clients_sockets.remove(sock)
+                                sock.close()
+                                continue
                             self.handle_data(sock, data)
                         except (KeyboardInterrupt, SystemExit) as ex:
                             raise ex
                         except Exception as ex:
-                            print(f'Error: {ex}')
+                            logger.warning(f'Error: {ex}')
                             continue
             except (KeyboardInterrupt, SystemExit):
                 break
@@ -67,13 +75,13 @@ class TransmissionSender(ABC):
         self.server_port = server_port
         self.sender_socket = None
 
-    def connect(self):
+    # @timeout{float} seconds to wait for the connection, None to wait as long as the OS does.
+    def connect(self, timeout=None):
         try:
-            self.sender_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sender_socket.connect((self.server_host, self.server_port))
+            self.sender_socket = socket.create_connection((self.server_host, self.server_port), timeout)
             return True
         except Exception as ex:
-            print(ex)
+            logger.debug(ex)
             return False
 
     @abstractmethod
@@ -180,3 +180,128 @@ def from_crop_coordinate_system(bbox_to_change, crop_location, crop_padding, cro
     bbox_to_change *= crop_location_xywh[[2,3,2,3]] / crop_size
     bbox_to_change += crop_location[[0,1,0,1]]
     return bbox_to_change
+
+
+# Batch API. These operate on contiguous 4xN float32 arrays (one box per column) and write into an
+#   optional preallocated @out buffer, so a whole frame's worth of boxes is converted in a single call
+#   without per-box temporaries. Nx4 arrays can be passed as their transpose (boxes.T), which is a view.
+#   @out may be the input array itself for in-place conversion.
+def _batch_out(bboxes, out):
+    if out is None:
+        out = np.empty(bboxes.shape, dtype=np.float32)
+    return out
+
+
+# [x1 y1, x2, y2] to [xMid, yMid, width, height]
+# @bboxes{ndarray 4xN} boxes to convert.
+# @out{ndarray 4xN} optional output buffer.
+def xyxy_to_xywh_batch(bboxes, out=None):
+    out = _batch_out(bboxes, out)
+    for lo, hi in ((0, 2), (1, 3)):
+        # The order matters so that out can alias bboxes.
+        np.add(bboxes[lo], bboxes[hi], out=out[lo])
+        out[lo] *= 0.5
+        np.subtract(bboxes[hi], out[lo], out=out[hi])
+        out[hi] *= 2
+    return out
+
+
+# [xMid, yMid, width, height] to [x1 y1, x2, y2]
+# @bboxes{ndarray 4xN} boxes to convert.
+# @out{ndarray 4xN} optional output buffer.
+def xywh_to_xyxy_batch(bboxes, out=None):
+    out = _batch_out(bboxes, out)
+    for lo, hi in ((0, 2), (1, 3)):
+        np.multiply(bboxes[hi], 0.5, out=out[hi])
+        np.subtract(bboxes[lo], out[hi], out=out[lo])
+        out[hi] *= 2
+        out[hi] += out[lo]
+    return out
+
+
+# @bboxes{ndarray 4xN} boxes to be scaled
+# @scalars{number or ndarray 2xN} scalars for width and height of boxes
+# @out{ndarray 4xN} optional output buffer.
+def scale_bbox_batch(bboxes, scalars, out=None):
+    out = _batch_out(bboxes, out)
+    if isinstance(scalars, numbers.Number):
+        scalars = (scalars, scalars)
+    for axis, (lo, hi) in enumerate(((0, 2), (1, 3))):
+        # half size, then center, then the scaled corners.
+        np.subtract(bboxes[hi], bboxes[lo], out=out[hi])
+        out[hi] *= 0.5
+        np.add(bboxes[lo], out[hi], out=out[lo])
+        out[hi] *= scalars[axis]
+        out[lo] -= out[hi]
+        out[hi] *= 2
+        out[hi] += out[lo]
+    return out
+
+
+def _crop_transform(crop_locations, crop_padding, crop_size, work, inverse=False):
+    # Rows 0 and 1 of work get the x and y origin of the padded crops, rows 2 and 3 get
+    #   crop_size divided by the padded crop width and height, or with inverse the padded crop width and height
+    #   divided by crop_size, so that both directions multiply.
+    if work is None:
+        work = np.empty((4, crop_locations.shape[1]), dtype=np.float32)
+    for axis, (lo, hi) in enumerate(((0, 2), (1, 3))):
+        origin = work[axis]
+        scale = work[axis + 2]
+        np.add(crop_locations[lo], crop_locations[hi], out=origin)
+        origin *= 0.5
+        np.subtract(crop_locations[hi], crop_locations[lo], out=scale)
+        scale *= crop_padding * 0.5
+        origin -= scale
+        if inverse:
+            scale *= 2 / crop_size
+        else:
+            np.divide(crop_size * 0.5, scale, out=scale)
+    return work
+
+
+# Batch version of to_crop_coordinate_system.
+# @bboxes{ndarray 4xN} xyxy boxes whose coordinates will be converted, one per crop.
+# @crop_locations{ndarray 4xN} xyxy boxes of the crops (without padding).
+# @out{ndarray 4xN} optional output buffer, may be bboxes.
+# @work{ndarray 4xN} optional float32 scratch buffer.
+def to_crop_coordinate_system_batch(bboxes, crop_locations, crop_padding, crop_size, out=None, work=None):
+    out = _batch_out(bboxes, out)
+    work = _crop_transform(crop_locations, crop_padding, crop_size, work)
+    for row in range(4):
+        np.subtract(bboxes[row], work[row % 2], out=out[row])
+        out[row] *= work[row % 2 + 2]
+    return out
+
+
+# Batch version of from_crop_coordinate_system.
+# @bboxes{ndarray 4xN} xyxy boxes in crop coordinates, one per crop.
+# @crop_locations{ndarray 4xN} xyxy boxes of the crops (without padding).
+# @out{ndarray 4xN} optional output buffer, may be bboxes.
+# @work{ndarray 4xN} optional float32 scratch buffer.
+def from_crop_coordinate_system_batch(bboxes, crop_locations, crop_padding, crop_size, out=None, work=None):
+    out = _batch_out(bboxes, out)
+    work = _crop_transform(crop_locations, crop_padding, crop_size, work, inverse=True)
+    for row in range(4):
+        np.multiply(bboxes[row], work[row % 2 + 2], out=out[row])
+        out[row] += work[row % 2]
+    return out
+
+
+# Pairwise intersection over union.
+# @bboxes_a{ndarray 4xN} xyxy boxes.
+# @bboxes_b{ndarray 4xM} xyxy boxes.
+# @return{ndarray NxM} iou of every pair.
+def iou_matrix(bboxes_a, bboxes_b):
+    bboxes_a = np.asarray(bboxes_a, dtype=np.float32)
+    bboxes_b = np.asarray(bboxes_b, dtype=np.float32)
+    inter_w = np.minimum(bboxes_a[2][:, np.newaxis], bboxes_b[2][np.newaxis, :]) - \
+        np.maximum(bboxes_a[0][:, np.newaxis], bboxes_b[0][np.newaxis, :])
+    inter_h = np.minimum(bboxes_a[3][:, np.newaxis], bboxes_b[3][np.newaxis, :]) - \
+        np.maximum(bboxes_a[1][:, np.newaxis], bboxes_b[1][np.newaxis, :])
+    np.clip(inter_w, 0, None, out=inter_w)
+    np.clip(inter_h, 0, None, out=inter_h)
+    inter = inter_w * inter_h
+    area_a = (bboxes_a[2] - bboxes_a[0]) * (bboxes_a[3] - bboxes_a[1])
+    area_b = (bboxes_b[2] - bboxes_b[0]) * (bboxes_b[3] - bboxes_b[1])
+    union = area_a[:, np.newaxis] + area_b[np.newaxis, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
@@ -36,8 +36,9 @@ def get_cropped_input(inputImage, bbox, padScale, outputSize):
     outputBox = boxOn.copy()
     boxOn = np.round(boxOn).astype(int)
     boxOnWH = np.array([boxOn[2] - boxOn[0], boxOn[3] - boxOn[1]])
-    imagePatch = inputImage[max(boxOn[1], 0):min(boxOn[3], imShape[0]),
-            max(boxOn[0], 0):min(boxOn[2], imShape[1]), :]
+    # Upper bounds are kept >= 0 so boxes left of or above the image do not slice from the end.
+    imagePatch = inputImage[max(boxOn[1], 0):max(min(boxOn[3], imShape[0]), 0),
+            max(boxOn[0], 0):max(min(boxOn[2], imShape[1]), 0), :]
     boundedBox = np.clip(boxOn, 0, imShape[[1,0,1,0]])
     boundedBoxWH = np.array([boundedBox[2] - boundedBox[0], boundedBox[3] - boundedBox[1]])
 
@@ -59,7 +60,7 @@ def get_cropped_input(inputImage, bbox, padScale, outputSize):
             if len(pad[pad < 0]) > 0:
                 patch = np.zeros((int(outputSize), int(outputSize), 3))
             else:
-                patch = np.lib.pad(
+                patch = np.pad(
                         patch,
                         ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)),
                         'constant', constant_values=0)